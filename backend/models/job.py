@@ -29,6 +29,16 @@ class TableInfo(BaseModel):
     error: Optional[str] = None
     percent: int = 0
     migrated_rows: int = 0
+    copy_format: Optional[str] = None  # text, binary
+    avg_row_bytes: Optional[float] = None  # observed in-memory row width
+    # From partition stats: heap/clustered index size, and space reserved by all indexes
+    data_bytes: Optional[int] = None
+    reserved_bytes: Optional[int] = None
+    row_count_exact: bool = False  # row_count came from COUNT(*), not metadata
+
+class StageTiming(BaseModel):
+    busy_sec: float = 0
+    idle_sec: float = 0
 
 class JobStats(BaseModel):
     tables_done: int = 0
@@ -36,6 +46,18 @@ class JobStats(BaseModel):
     elapsed_sec: float = 0
     current_table: Optional[str] = None
     rows_migrated: int = 0
+    # Data copy pipeline timings per stage: read, encode, write
+    pipeline: Dict[str, StageTiming] = Field(default_factory=dict)
+    # WAL generated per stage (data_copy, set_logged), None if not measurable
+    wal_bytes: Dict[str, Optional[int]] = Field(default_factory=dict)
+    # Wall time of individual stages (schema_discovery, ...)
+    stage_durations: Dict[str, float] = Field(default_factory=dict)
+    # Schema cache lookups (schema_info and DDL) for this job
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Uploaded .bak size and end-to-end upload throughput (write + transfer to MSSQL)
+    upload_bytes: int = 0
+    upload_mb_per_sec: Optional[float] = None
 
 class Job(BaseModel):
     job_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -51,6 +73,57 @@ class Job(BaseModel):
     completed_at: Optional[datetime] = None
     error: Optional[str] = None
     is_demo: bool = False
+    # SHA-256 of the uploaded .bak, keys the schema cache
+    backup_sha256: Optional[str] = None
+    # MSSQL database the job reads from: a warm cached restore, or the job's own
+    # TEMP_DB_<job id> that is dropped when the job ends
+    source_database: Optional[str] = None
+    # Fixed rows per batch; None sizes batches from batch_memory_mb and row width
+    batch_size: Optional[int] = None
+    batch_memory_mb: int = 1024
+    queue_depth: int = 4
+    # Number of tables (or key ranges) copied concurrently
+    parallelism: int = 4
+    # Tables with more rows are split into primary-key ranges
+    partition_rows: int = 5_000_000
+    # Requested COPY format: text or binary (tables with unsupported types fall back to text)
+    copy_format: str = "text"
+    # Load into UNLOGGED tables, commit once per table/range, SET LOGGED before constraints
+    fast_load: bool = False
+    # Connections building primary keys and indexes concurrently, and their session settings
+    index_parallelism: int = 4
+    maintenance_work_mem_mb: int = 256
+    max_parallel_maintenance_workers: int = 2
+    # Also COUNT(*) every source table in the background; validation waits for it
+    exact_row_counts: bool = False
+    # count: compare row counts; checksum: also compare row hashes per key range
+    validation_mode: str = "count"
+    validate_chunk_rows: int = 100_000
+    # Scheduler priority: waiting jobs with a higher value get free slots first
+    priority: int = 0
+
+class UploadSession(BaseModel):
+    """A chunked .bak upload; the job is created when it is completed"""
+    upload_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    filename: str
+    size: int
+    chunk_size: int
+    # create_job arguments (pg_uri, schema and the tuning options)
+    job_options: Dict[str, Any] = Field(default_factory=dict)
+    # SHA-256 of every chunk received so far, by chunk index
+    chunk_sha256: Dict[int, str] = Field(default_factory=dict)
+    # SHA-256 of the whole file as declared by the client, checked on completion
+    sha256: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Last chunk received; idle sessions expire after UPLOAD_SESSION_TTL_SEC
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    @property
+    def chunk_count(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
 
 class ProgressEvent(BaseModel):
     event_type: str  # stage, table_progress, log, done, error
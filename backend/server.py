@@ -5,17 +5,19 @@ from dotenv import load_dotenv
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-from fastapi import FastAPI, APIRouter, UploadFile, File, Form, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, APIRouter, Form, Depends, Request, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.responses import FileResponse
 
 from starlette.middleware.cors import CORSMiddleware
 import os
+import inspect
 import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from pydantic import TypeAdapter, ValidationError
 
-import asyncio
-
-from services import upload_service, migration_service
-from services.migration_service import jobs
+from services import upload_service, upload_sessions, migration_service, job_store, scheduler
+from models.job import JobStatus
 from utils.websocket_manager import manager
 import psycopg
 
@@ -53,7 +55,7 @@ async def import_demo():
         )
         
         # Start demo migration in background
-        asyncio.create_task(migration_service.run_demo_migration(job_id))
+        scheduler.submit(migration_service.run_demo_migration(job_id))
         
         return {"jobId": job_id, "status": "queued", "demo": True}
     
@@ -61,55 +63,272 @@ async def import_demo():
         logger.error(f"Demo import failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.post("/import")
-async def import_backup(
-    file: UploadFile = File(...),
+async def _import_options(
     pgUri: str = Form(...),
-    schema: str = Form("public")
-):
+    schema: str = Form("public"),
+    batchSize: Optional[int] = Form(None),
+    batchMemoryMb: int = Form(1024),
+    queueDepth: int = Form(4),
+    parallelism: int = Form(4),
+    partitionRows: int = Form(5000000),
+    copyFormat: str = Form("text"),
+    fastLoad: bool = Form(False),
+    indexParallelism: int = Form(4),
+    maintenanceWorkMemMb: int = Form(256),
+    maxParallelMaintenanceWorkers: int = Form(2),
+    exactRowCounts: bool = Form(False),
+    validationMode: str = Form("count"),
+    validateChunkRows: int = Form(100000),
+    priority: int = Form(0)
+) -> dict:
     """
-    Upload .bak file and start migration
+    Validate the migration form fields and test the PostgreSQL connection;
+    returns create_job keyword arguments
     """
+    if (batchSize is not None and batchSize < 1) or batchMemoryMb < 1 or queueDepth < 1 \
+            or parallelism < 1 or partitionRows < 1:
+        raise HTTPException(status_code=400, detail="batchSize, batchMemoryMb, queueDepth, parallelism ve partitionRows en az 1 olmalıdır")
+    
+    if copyFormat not in ("text", "binary"):
+        raise HTTPException(status_code=400, detail="copyFormat 'text' veya 'binary' olmalıdır")
+    
+    if validationMode not in ("count", "checksum") or validateChunkRows < 1:
+        raise HTTPException(status_code=400, detail="validationMode 'count' veya 'checksum', validateChunkRows en az 1 olmalıdır")
+    
+    if indexParallelism < 1 or maintenanceWorkMemMb < 1 or maxParallelMaintenanceWorkers < 0:
+        raise HTTPException(status_code=400, detail="indexParallelism ve maintenanceWorkMemMb en az 1, maxParallelMaintenanceWorkers en az 0 olmalıdır")
+    
+    # Fix PostgreSQL URI for Docker environment
+    # Replace localhost/127.0.0.1 with 'postgres' service name
+    fixed_pgUri = pgUri.replace('localhost', 'postgres').replace('127.0.0.1', 'postgres')
+    
+    # Test PostgreSQL connection
     try:
-        # Validate file extension
-        if not file.filename.endswith('.bak'):
-            raise HTTPException(status_code=400, detail="Sadece .bak dosyaları desteklenmektedir")
-        
-        # Fix PostgreSQL URI for Docker environment
-        # Replace localhost/127.0.0.1 with 'postgres' service name
-        fixed_pgUri = pgUri.replace('localhost', 'postgres').replace('127.0.0.1', 'postgres')
-        
-        # Test PostgreSQL connection
-        try:
-            conn = await psycopg.AsyncConnection.connect(fixed_pgUri)
-            await conn.close()
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"PostgreSQL bağlantısı başarısız: {e}")
-        
-        # Create job with fixed URI
-        job_id = await migration_service.create_job(fixed_pgUri, schema, file.filename)
-        
-        # Save uploaded file
-        bak_path, sha256 = await upload_service.save_upload_file(file, job_id)
-        logger.info(f"File uploaded: {bak_path}, SHA256: {sha256}")
-        
-        # Start migration in background
-        asyncio.create_task(migration_service.run_migration(job_id))
-        
-        return {"jobId": job_id, "status": "queued"}
+        conn = await psycopg.AsyncConnection.connect(fixed_pgUri)
+        await conn.close()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"PostgreSQL bağlantısı başarısız: {e}")
     
-    except HTTPException:
+    return {
+        "pg_uri": fixed_pgUri,
+        "schema": schema,
+        "batch_size": batchSize,
+        "batch_memory_mb": batchMemoryMb,
+        "queue_depth": queueDepth,
+        "parallelism": parallelism,
+        "partition_rows": partitionRows,
+        "copy_format": copyFormat,
+        "fast_load": fastLoad,
+        "index_parallelism": indexParallelism,
+        "maintenance_work_mem_mb": maintenanceWorkMemMb,
+        "max_parallel_maintenance_workers": maxParallelMaintenanceWorkers,
+        "exact_row_counts": exactRowCounts,
+        "validation_mode": validationMode,
+        "validate_chunk_rows": validateChunkRows,
+        "priority": priority
+    }
+
+async def _start_uploaded_job(job_id: str, sha256: str, upload_stats: dict):
+    """Record the upload on the job and queue the migration"""
+    job = await migration_service.get_job(job_id)
+    job.backup_sha256 = sha256
+    job.stats.upload_bytes = upload_stats['bytes']
+    job.stats.upload_mb_per_sec = upload_stats['mb_per_sec']
+    job.stats.stage_durations['upload'] = upload_stats['write_sec']
+    job.stats.stage_durations['upload_transfer'] = upload_stats['transfer_sec']
+    if 'hash_sec' in upload_stats:
+        job.stats.stage_durations['upload_hash'] = upload_stats['hash_sec']
+    
+    # Queue the migration; it starts once the scheduler has a restore slot
+    scheduler.submit(migration_service.run_migration(job_id))
+
+async def _fail_job(job_id: str, error: Exception):
+    """Fail a job whose backup never arrived, instead of leaving it queued forever"""
+    job = await migration_service.get_job(job_id)
+    job.status = JobStatus.FAILED
+    job.error = str(error)
+    job.completed_at = datetime.now(timezone.utc)
+    job_store.mark_dirty(job)
+
+def _form_arguments(fields: Dict[str, str]) -> dict:
+    """_import_options arguments from raw form fields, typed and defaulted like FastAPI does"""
+    arguments = {}
+    for name, param in inspect.signature(_import_options).parameters.items():
+        if name in fields:
+            try:
+                arguments[name] = TypeAdapter(param.annotation).validate_python(fields[name])
+            except ValidationError:
+                raise HTTPException(status_code=400, detail=f"Geçersiz {name} değeri: {fields[name]}")
+        elif param.default.is_required():
+            raise HTTPException(status_code=400, detail=f"{name} alanı zorunludur")
+        else:
+            arguments[name] = param.default.default
+    return arguments
+
+@api_router.post("/import")
+async def import_backup(request: Request):
+    """
+    Upload .bak file (multipart field "file", with the _import_options fields) and start migration.
+    The body is parsed as it arrives, so the file is written once, straight to where it is stored
+    """
+    try:
+        fields, filename, part_path, sha256, upload_stats = await upload_service.receive_multipart(
+            request.stream(), request.headers.get('content-type', ''))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Import failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    try:
+        # The browser sends the options after the file, so they are only known now
+        options = await _import_options(**_form_arguments(fields))
+        job_id = await migration_service.create_job(bak_filename=filename, **options)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
         raise
+    
+    try:
+        bak_path, upload_stats = await upload_service.store_upload(part_path, f"{job_id}_{filename}", upload_stats)
     except Exception as e:
+        part_path.unlink(missing_ok=True)
+        await _fail_job(job_id, e)
         logger.error(f"Import failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    
+    logger.info(f"File uploaded: {bak_path}, SHA256: {sha256}, {upload_stats['mb_per_sec']} MB/s")
+    await _start_uploaded_job(job_id, sha256, upload_stats)
+    
+    return {"jobId": job_id, "status": "queued"}
+
+@api_router.post("/uploads")
+async def create_upload(
+    filename: str = Form(...),
+    size: int = Form(...),
+    chunkSize: int = Form(64 * 1024 * 1024),
+    sha256: Optional[str] = Form(None),
+    options: dict = Depends(_import_options)
+):
+    """
+    Start a resumable chunked upload; the migration starts when it is completed.
+    An optional sha256 of the whole file is verified on completion
+    """
+    if not filename.endswith('.bak') or Path(filename).name != filename:
+        raise HTTPException(status_code=400, detail="Sadece .bak dosyaları desteklenmektedir")
+    try:
+        session = await upload_sessions.create(filename, size, chunkSize, options, sha256)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"uploadId": session.upload_id, "chunkSize": session.chunk_size, "chunkCount": session.chunk_count}
+
+def _get_upload(upload_id: str):
+    session = upload_sessions.get(upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload bulunamadı")
+    return session
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """
+    Upload progress: which chunks arrived and which are still missing
+    """
+    session = _get_upload(upload_id)
+    return {
+        "uploadId": session.upload_id,
+        "filename": session.filename,
+        "size": session.size,
+        "chunkSize": session.chunk_size,
+        "chunkCount": session.chunk_count,
+        "received": sorted(session.chunk_sha256),
+        "missing": upload_sessions.missing_chunks(session)
+    }
+
+@api_router.put("/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request):
+    """
+    Upload one chunk as the raw request body; chunks may be sent in parallel.
+    An optional X-Chunk-Sha256 header is verified against the received bytes
+    """
+    session = _get_upload(upload_id)
+    try:
+        sha256 = await upload_sessions.write_chunk(
+            session, index, request.stream(), request.headers.get('X-Chunk-Sha256'))
+    except ValueError as e:
+        if upload_sessions.get(upload_id) is not session:
+            # Completed or deleted while this chunk was waiting
+            raise HTTPException(status_code=409, detail=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"index": index, "sha256": sha256}
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    """
+    Assemble a fully received upload into a job and start the migration
+    """
+    session = _get_upload(upload_id)
+    missing = upload_sessions.missing_chunks(session)
+    if missing:
+        raise HTTPException(status_code=409, detail=f"Eksik chunk'lar: {missing[:100]}")
+    if upload_sessions.writing(session):
+        raise HTTPException(status_code=409, detail="Chunk yazımı sürüyor, upload henüz tamamlanamaz")
+    
+    job_id = await migration_service.create_job(bak_filename=session.filename, **session.job_options)
+    try:
+        bak_path, sha256, upload_stats = await upload_sessions.complete(session, job_id)
+    except Exception as e:
+        await _fail_job(job_id, e)
+        if isinstance(e, ValueError):
+            # Completed concurrently by another request
+            raise HTTPException(status_code=409, detail=str(e))
+        logger.error(f"Upload completion failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    logger.info(f"Chunked upload assembled: {bak_path}, SHA256: {sha256}, {upload_stats['mb_per_sec']} MB/s")
+    await _start_uploaded_job(job_id, sha256, upload_stats)
+    
+    return {"jobId": job_id, "status": "queued"}
+
+@api_router.delete("/uploads/{upload_id}")
+async def delete_upload(upload_id: str):
+    """
+    Abandon an upload and remove its data
+    """
+    upload_sessions.discard(_get_upload(upload_id))
+    return {"uploadId": upload_id, "deleted": True}
+
+@api_router.get("/jobs")
+async def list_jobs(status: Optional[str] = None, backupSha256: Optional[str] = None, limit: int = 50):
+    """
+    List jobs, newest first, optionally filtered by status and backup SHA-256
+    """
+    try:
+        job_status = JobStatus(status) if status else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Geçersiz status değeri")
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit 1 ile 500 arasında olmalı")
+    
+    jobs = await migration_service.list_jobs(job_status, backupSha256, limit)
+    return {"jobs": [{
+        "jobId": job.job_id,
+        "status": job.status,
+        "stage": job.stage,
+        "percent": job.percent,
+        "bakFilename": job.bak_filename,
+        "backupSha256": job.backup_sha256,
+        "createdAt": job.created_at,
+        "completedAt": job.completed_at,
+        "error": job.error
+    } for job in jobs]}
 
 @api_router.get("/jobs/{job_id}")
 async def get_job_status(job_id: str):
     """
     Get job status and progress
     """
-    job = migration_service.get_job(job_id)
+    job = await migration_service.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job bulunamadı")
     
@@ -118,21 +337,49 @@ async def get_job_status(job_id: str):
         "status": job.status,
         "stage": job.stage,
         "percent": job.percent,
+        "queue": scheduler.queue_position(job.job_id),
         "currentTable": job.stats.current_table,
         "stats": {
             "tablesDone": job.stats.tables_done,
             "tablesTotal": job.stats.tables_total,
-            "elapsedSec": job.stats.elapsed_sec
+            "elapsedSec": job.stats.elapsed_sec,
+            "pipeline": {
+                stage: {"busySec": round(t.busy_sec, 2), "idleSec": round(t.idle_sec, 2)}
+                for stage, t in job.stats.pipeline.items()
+            },
+            "fastLoad": job.fast_load,
+            "walBytes": job.stats.wal_bytes,
+            "stageDurations": {stage: round(sec, 2) for stage, sec in job.stats.stage_durations.items()},
+            "cacheHits": job.stats.cache_hits,
+            "cacheMisses": job.stats.cache_misses,
+            "uploadBytes": job.stats.upload_bytes,
+            "uploadMbPerSec": job.stats.upload_mb_per_sec
         },
         "error": job.error
     }
 
+@api_router.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    """
+    Resume a failed migration from its last checkpoint
+    """
+    try:
+        job = await migration_service.prepare_resume(job_id)
+    except ValueError:
+        raise HTTPException(status_code=409, detail="Sadece başarısız job'lar devam ettirilebilir")
+    if not job:
+        raise HTTPException(status_code=404, detail="Job için checkpoint bulunamadı")
+
+    scheduler.submit(migration_service.run_migration(job_id, resume=True))
+
+    return {"jobId": job_id, "status": "queued"}
+
 @api_router.get("/jobs/{job_id}/tables")
 async def get_job_tables(job_id: str):
     """
     Get list of tables for a job
     """
-    job = migration_service.get_job(job_id)
+    job = await migration_service.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job bulunamadı")
     
@@ -141,6 +388,13 @@ async def get_job_tables(job_id: str):
         "name": t.table_name,
         "rowCount": t.row_count,
         "copied": t.copied,
+        "percent": t.percent,
+        "migratedRows": t.migrated_rows,
+        "durationSec": t.duration_sec,
+        "copyFormat": t.copy_format,
+        "avgRowBytes": t.avg_row_bytes,
+        "reservedBytes": t.reserved_bytes,
+        "rowCountExact": t.row_count_exact,
         "error": t.error
     } for t in job.tables]
     
@@ -151,7 +405,7 @@ async def get_table_data(job_id: str, table_name: str, page: int = 1, pageSize:
     """
     Get paginated table data
     """
-    job = migration_service.get_job(job_id)
+    job = await migration_service.get_job(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job bulunamadı")
     
@@ -296,9 +550,9 @@ def _get_demo_table_data(table_name: str, page: int, pageSize: int):
 @api_router.get("/jobs/{job_id}/artifacts/{filename}")
 async def download_artifact(job_id: str, filename: str):
     """
-    Download artifact file (schema.sql, rowcount.csv, errors.log)
+    Download artifact file (schema.sql, rowcount.csv, checksum.csv, fk_validation.csv, errors.log)
     """
-    allowed_files = ['schema.sql', 'rowcount.csv', 'errors.log']
+    allowed_files = ['schema.sql', 'rowcount.csv', 'checksum.csv', 'fk_validation.csv', 'errors.log']
     if filename not in allowed_files:
         raise HTTPException(status_code=400, detail="Geçersiz dosya adı")
     
@@ -308,6 +562,28 @@ async def download_artifact(job_id: str, filename: str):
     
     return FileResponse(artifact_path, filename=filename)
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """
+    Runtime metrics: MSSQL executor workers, queue depth and wait times,
+    schema and restored-database cache hits, cached jobs, scheduler slots.
+    Without pyodbc (e.g. demo mode) the MSSQL executor and restore cache are left out
+    """
+    from services import schema_cache
+    metrics = {
+        "schemaCache": schema_cache.stats(),
+        "jobStore": job_store.stats(),
+        "scheduler": scheduler.stats()
+    }
+    try:
+        from services import mssql_service, restore_cache
+    except ImportError as e:
+        logger.debug(f"MSSQL metrics unavailable: {e}")
+        return metrics
+    metrics["mssqlExecutor"] = mssql_service.get_executor_metrics()
+    metrics["restoreCache"] = restore_cache.stats()
+    return metrics
+
 @api_router.websocket("/jobs/{job_id}/stream")
 async def websocket_endpoint(websocket: WebSocket, job_id: str):
     """
@@ -324,6 +600,18 @@ async def websocket_endpoint(websocket: WebSocket, job_id: str):
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(websocket, job_id)
 
+@app.on_event("startup")
+async def start_job_store():
+    await job_store.start()
+    await upload_sessions.start()
+    await migration_service.start()
+
+@app.on_event("shutdown")
+async def stop_job_store():
+    await migration_service.stop()
+    await upload_sessions.stop()
+    await job_store.stop()
+
 # Include the router in the main app
 app.include_router(api_router)
 
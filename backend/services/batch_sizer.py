@@ -0,0 +1,77 @@
+"""
+Adaptive batch sizing for the data copy.
+Batches are sized from a byte budget instead of a fixed row count: wide rows
+(nvarchar(max), varbinary(max)) get small batches, narrow rows get large ones.
+"""
+from typing import List, Optional
+
+MIN_BATCH_ROWS = 1
+MAX_BATCH_ROWS = 200_000
+DEFAULT_ROW_BYTES = 512
+
+# Approximate Python object overhead, so the budget tracks real memory use
+_TUPLE_OVERHEAD = 56
+_SLOT_BYTES = 8
+_STR_OVERHEAD = 49
+_BYTES_OVERHEAD = 33
+_SCALAR_BYTES = 32
+
+# Rows inspected per batch when measuring width
+_SAMPLE_ROWS = 64
+
+# Fetched rows take more memory than their on-disk pages (Python objects per value)
+_DISK_TO_MEMORY = 2.0
+
+def batch_budget_bytes(job_budget_mb: int, parallelism: int, queue_depth: int) -> int:
+    """
+    Split a job's memory budget into a per-batch budget.
+    Each copy worker can hold a batch in every queue slot of both queues
+    plus one batch inside each of the three stages.
+    """
+    batches_in_flight = max(1, parallelism) * (2 * max(1, queue_depth) + 3)
+    return max(1, job_budget_mb * 1024 * 1024 // batches_in_flight)
+
+def estimate_row_bytes(row: tuple) -> int:
+    """Rough in-memory size of one fetched row"""
+    size = _TUPLE_OVERHEAD + _SLOT_BYTES * len(row)
+    for val in row:
+        if val is None:
+            continue
+        if isinstance(val, str):
+            size += _STR_OVERHEAD + len(val) if val.isascii() else _STR_OVERHEAD + 4 * len(val)
+        elif isinstance(val, (bytes, bytearray)):
+            size += _BYTES_OVERHEAD + len(val)
+        else:
+            size += _SCALAR_BYTES
+    return size
+
+class BatchSizer:
+    """
+    Picks the next batch's row count from a byte budget. Starts from the on-disk
+    row width (MSSQL partition stats) and follows the widths it observes.
+    fixed_rows disables adaptation.
+    """
+    def __init__(self, budget_bytes: int, disk_row_bytes: Optional[float] = None,
+                 fixed_rows: Optional[int] = None, smoothing: float = 0.3):
+        self.budget_bytes = budget_bytes
+        self.fixed_rows = fixed_rows
+        self.smoothing = smoothing
+        if disk_row_bytes:
+            self.avg_row_bytes = float(disk_row_bytes) * _DISK_TO_MEMORY + _TUPLE_OVERHEAD
+        else:
+            self.avg_row_bytes = float(DEFAULT_ROW_BYTES)
+
+    def next_size(self) -> int:
+        if self.fixed_rows:
+            return self.fixed_rows
+        rows = int(self.budget_bytes / max(self.avg_row_bytes, 1.0))
+        return max(MIN_BATCH_ROWS, min(MAX_BATCH_ROWS, rows))
+
+    def observe(self, rows: List[tuple]):
+        """Update the row width estimate from a fetched batch"""
+        if not rows:
+            return
+        step = max(1, len(rows) // _SAMPLE_ROWS)
+        sample = rows[::step]
+        observed = sum(estimate_row_bytes(row) for row in sample) / len(sample)
+        self.avg_row_bytes += self.smoothing * (observed - self.avg_row_bytes)
@@ -0,0 +1,156 @@
+"""
+Durable job checkpoints for resuming a failed migration.
+A checkpoint records the job itself, the last finished stage, the key ranges
+every table was split into and which ranges are committed. The discovered
+schema is written once, to a file of its own, so progress writes stay small.
+Files are written atomically (temp file + rename) in a worker thread; range
+updates are throttled because redoing an unrecorded range on resume is safe,
+just slower.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = Path(os.environ.get('CHECKPOINT_DIR', Path(__file__).parent.parent / "checkpoints"))
+CHECKPOINT_INTERVAL_SEC = float(os.environ.get('CHECKPOINT_INTERVAL_SEC', '2'))
+# Checkpoints of failed jobs not resumed for this long expire
+CHECKPOINT_TTL_SEC = int(os.environ.get('CHECKPOINT_TTL_SEC', str(7 * 24 * 3600)))
+
+# Stages in pipeline order; a resumed job skips every stage up to the recorded one.
+# 'started' is written before anything runs, so a job that dies in restore can be resumed
+STAGES = ('started', 'restored', 'schema_discovered', 'ddl_applied', 'data_copied', 'constraints_applied')
+
+# Key range bounds keep their type through JSON, so a resumed job selects
+# exactly the ranges it recorded (a datetime must not come back as a string)
+_BOUND_TYPES = {
+    'datetime': (datetime, datetime.isoformat, datetime.fromisoformat),
+    'date': (date, date.isoformat, date.fromisoformat),
+    'time': (dt_time, dt_time.isoformat, dt_time.fromisoformat),
+    'decimal': (Decimal, str, Decimal),
+    'uuid': (uuid.UUID, str, uuid.UUID),
+    'bytes': (bytes, bytes.hex, bytes.fromhex),
+}
+
+def _encode_bound(value: Any) -> Any:
+    # datetime before date: it is a date subclass
+    for tag, (cls, encode, _) in _BOUND_TYPES.items():
+        if isinstance(value, cls):
+            return {'$type': tag, 'v': encode(value)}
+    return value
+
+def _decode_bound(value: Any) -> Any:
+    if isinstance(value, dict):
+        return _BOUND_TYPES[value['$type']][2](value['v'])
+    return value
+
+def _path(job_id: str) -> Path:
+    return CHECKPOINT_DIR / f"{job_id}.json"
+
+def _schema_path(job_id: str) -> Path:
+    return CHECKPOINT_DIR / f"{job_id}.schema.json"
+
+def _write(path: Path, text: str):
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+def load(job_id: str) -> Optional[Dict[str, Any]]:
+    """Saved checkpoint data of a job, or None"""
+    try:
+        return json.loads(_path(job_id).read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unreadable checkpoint for {job_id}: {e}")
+        return None
+
+def expired() -> List[str]:
+    """IDs of jobs whose checkpoint was last written more than CHECKPOINT_TTL_SEC ago"""
+    if not CHECKPOINT_DIR.exists():
+        return []
+    cutoff = time.time() - CHECKPOINT_TTL_SEC
+    return [path.stem for path in CHECKPOINT_DIR.glob('*.json')
+            if not path.name.endswith('.schema.json') and path.stat().st_mtime < cutoff]
+
+def delete(job_id: str):
+    _path(job_id).unlink(missing_ok=True)
+    _schema_path(job_id).unlink(missing_ok=True)
+
+class Checkpoint:
+    """Checkpoint of one running job; job is the Job model, saved with every write"""
+    def __init__(self, job, data: Optional[Dict[str, Any]] = None):
+        self.job = job
+        self.data = data or {'stage': None, 'ranges': {}, 'done_ranges': {}}
+        self._saved_at = 0.0
+        self._dirty = False
+        # Writes run in threads; the lock keeps them in the order they were taken
+        self._write_lock = asyncio.Lock()
+
+    def reached(self, stage: str) -> bool:
+        """True if stage (or a later one) finished before"""
+        current = self.data.get('stage')
+        return current is not None and STAGES.index(current) >= STAGES.index(stage)
+
+    async def mark_stage(self, stage: str):
+        """Record a finished stage; a resumed job passing an earlier one keeps its progress"""
+        if not self.reached(stage):
+            self.data['stage'] = stage
+            await self.save(force=True)
+
+    async def save_schema(self, schema_info: Dict[str, Any]):
+        """Write the discovered schema, once per job"""
+        text = json.dumps(schema_info, default=str)
+        async with self._write_lock:
+            await asyncio.to_thread(_write, _schema_path(self.job.job_id), text)
+
+    async def load_schema(self) -> Dict[str, Any]:
+        return json.loads(await asyncio.to_thread(_schema_path(self.job.job_id).read_text))
+
+    def table_ranges(self, table: str) -> Optional[List[Any]]:
+        """Key ranges a table was split into, or None if not planned yet"""
+        ranges = self.data['ranges'].get(table)
+        if ranges is None:
+            return None
+        return [tuple(_decode_bound(b) for b in r) if r is not None else None for r in ranges]
+
+    def set_table_ranges(self, table: str, ranges: List[Any]):
+        self.data['ranges'][table] = [
+            [_encode_bound(b) for b in r] if r is not None else None for r in ranges
+        ]
+        self._dirty = True
+
+    def done_ranges(self, table: str) -> Dict[int, int]:
+        """Committed ranges of a table: {range index: rows copied}"""
+        return {int(idx): rows for idx, rows in self.data['done_ranges'].get(table, {}).items()}
+
+    async def range_done(self, table: str, range_idx: int, rows: int):
+        self.data['done_ranges'].setdefault(table, {})[str(range_idx)] = rows
+        self._dirty = True
+        await self.save()
+
+    def reset_table(self, table: str):
+        """Forget a table's committed ranges, e.g. when it is copied again from scratch"""
+        if self.data['done_ranges'].pop(table, None) is not None:
+            self._dirty = True
+
+    async def save(self, force: bool = False):
+        """Write if forced, or if there are changes and the last write is CHECKPOINT_INTERVAL_SEC old"""
+        now = time.monotonic()
+        if not force and (not self._dirty or now - self._saved_at < CHECKPOINT_INTERVAL_SEC):
+            return
+        self._saved_at = now
+        self._dirty = False
+        # Encoded on the loop, which mutates the job and ranges; only the write goes to a thread
+        text = json.dumps({**self.data, 'job': self.job.model_dump(mode='json', by_alias=True)}, default=str)
+        async with self._write_lock:
+            await asyncio.to_thread(_write, _path(self.job.job_id), text)
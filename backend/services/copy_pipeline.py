@@ -0,0 +1,135 @@
+"""
+Pipelined table copy: MSSQL read -> COPY encode -> PostgreSQL write.
+Stages run concurrently and hand batches over bounded queues, so reading
+batch N+1 overlaps with writing batch N.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from models.job import StageTiming
+from services import mssql_service, postgres_service
+from services.row_encoder import RowPlan, build_row_plan
+from services.batch_sizer import BatchSizer
+from utils.tasks import gather_or_cancel
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_STAGES = ('read', 'encode', 'write')
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+class _BatchEnd:
+    """Marks the last piece of a batch in the write queue"""
+    def __init__(self, row_count: int):
+        self.row_count = row_count
+
+class StageClock:
+    """Splits a stage's wall time into busy (working) and idle (waiting on a queue)"""
+    def __init__(self, timing: StageTiming):
+        self.timing = timing
+        self._mark = time.monotonic()
+
+    def _elapsed(self) -> float:
+        now = time.monotonic()
+        elapsed, self._mark = now - self._mark, now
+        return elapsed
+
+    def busy(self):
+        self.timing.busy_sec += self._elapsed()
+
+    def idle(self):
+        self.timing.idle_sec += self._elapsed()
+
+def init_timings(timings: Dict[str, StageTiming]):
+    """Make sure every pipeline stage has a timing entry"""
+    for stage in PIPELINE_STAGES:
+        timings.setdefault(stage, StageTiming())
+
+async def copy_table(
+    conn,
+    table_meta: Dict[str, Any],
+    target_schema: str,
+    batch_sizer: BatchSizer,
+    queue_depth: int,
+    timings: Dict[str, StageTiming],
+    on_progress: Callable[[int], Awaitable[None]],
+    key_range: Optional[Tuple[Any, Any]] = None,
+    row_plan: Optional[RowPlan] = None,
+    binary: bool = False,
+    commit_each_batch: bool = True,
+    database: Optional[str] = None,
+) -> int:
+    """
+    Copy one table, or one key_range of it, through the read/encode/write pipeline.
+    batch_sizer picks the row count of every fetch and learns the row width.
+    Values are converted with row_plan (built from table_meta if not given);
+    binary=True writes with binary COPY when the plan supports it.
+    commit_each_batch=False commits once after the last batch (fast-load mode).
+    database is the MSSQL source database (TEMP_DB if not given).
+    on_progress is awaited with the running row total after every batch.
+    Returns number of rows copied
+    """
+    init_timings(timings)
+    table_name = table_meta['name']
+    row_plan = row_plan or build_row_plan(table_meta)
+    columns = row_plan.columns
+    # Binary rows are encoded in the encode stage's threads, not by the COPY writer
+    dump_row = postgres_service.binary_row_dumper(conn, row_plan.binary_types) \
+        if binary and row_plan.binary_types else None
+
+    encode_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_depth)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_depth)
+    copied_rows = 0
+
+    async def read_stage():
+        clock = StageClock(timings['read'])
+        async for rows in mssql_service.iter_table_batches(table_meta, batch_sizer.next_size, key_range,
+                                                           database or mssql_service.TEMP_DB):
+            batch_sizer.observe(rows)
+            clock.busy()
+            await encode_queue.put(rows)
+            clock.idle()
+        await encode_queue.put(_DONE)
+
+    async def encode_stage():
+        clock = StageClock(timings['encode'])
+        while (rows := await encode_queue.get()) is not _DONE:
+            clock.idle()
+            # Hand the batch over in fixed-size chunks so memory does not grow with it
+            if dump_row:
+                chunks = row_plan.encode_binary_chunks(dump_row, rows)
+            else:
+                chunks = row_plan.encode_chunks(rows)
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                clock.busy()
+                await write_queue.put(chunk)
+                clock.idle()
+            await write_queue.put(_BatchEnd(len(rows)))
+        await write_queue.put(_DONE)
+
+    async def write_stage():
+        nonlocal copied_rows
+        clock = StageClock(timings['write'])
+        while (item := await write_queue.get()) is not _DONE:
+            clock.idle()
+            # One COPY per batch, fed with its pieces as they are encoded
+            async with postgres_service.open_copy(conn, target_schema, table_name, columns, dump_row is not None,
+                                                  commit=commit_each_batch) as copy:
+                while not isinstance(item, _BatchEnd):
+                    await copy.write(item)
+                    clock.busy()
+                    item = await write_queue.get()
+                    clock.idle()
+            copied_rows += item.row_count
+            clock.busy()
+            await on_progress(copied_rows)
+
+    # A failing stage stops the others
+    await gather_or_cancel(read_stage(), encode_stage(), write_stage())
+    if not commit_each_batch:
+        await conn.commit()
+
+    return copied_rows
@@ -0,0 +1,251 @@
+"""
+Checksum validation of copied data.
+Rows are read from MSSQL and PostgreSQL, normalized with the table's COPY text
+encoders and hashed. For every key range the row count and an order-independent
+sum of row hashes are compared, so the two sides need not return rows in the
+same order. A range that differs is split in two at its median key, and only the
+halves that still differ are checksummed again; where keys cannot be split (string,
+uniqueidentifier or datetime keys, heaps) the rows are split by a hash of their key
+instead. Parts of at most DRILL_DOWN_ROWS rows are compared row by row.
+"""
+import asyncio
+import hashlib
+import math
+import logging
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services import mssql_service, postgres_service
+from services.row_encoder import NULL, RowPlan
+from services.type_mapper import map_mssql_to_pg_type
+from utils.tasks import gather_or_cancel
+
+logger = logging.getLogger(__name__)
+
+VALIDATE_BATCH_ROWS = 10_000
+MAX_RANGES_PER_TABLE = 256
+# Mismatching parts up to this size are compared row by row, larger ones are split
+DRILL_DOWN_ROWS = 5_000
+MAX_REPORTED_KEYS = 100
+MAX_KEY_CHARS = 200
+# A hash split divides rows into 2**_HASH_SPLIT_BITS parts by the hash of their key
+_HASH_SPLIT_BITS = 8
+
+_HASH_MASK = (1 << 64) - 1
+
+# Leading key types that compare the same in both databases, so a key range
+# selects the same rows on each side (string and uniqueidentifier order differs).
+# Not datetime/smalldatetime: pyodbc binds the bounds as datetime2, and MSSQL then
+# compares the column's 1/300 s ticks exactly, moving boundary rows on its side only.
+# datetime2 only up to scale 6: pyodbc truncates 100 ns ticks to microseconds
+_RANGE_KEY_TYPES = {
+    'tinyint', 'smallint', 'int', 'bigint', 'decimal', 'numeric', 'date',
+}
+
+def _range_key(col: Dict[str, Any]) -> bool:
+    type_name = col['type'].lower()
+    return type_name in _RANGE_KEY_TYPES or (type_name == 'datetime2' and col['scale'] <= 6)
+
+def _encode_real(val) -> str:
+    # pyodbc widens real to double, PostgreSQL prints the shortest float4 text
+    return format(val, '.7g')
+
+def _trim_padding(encode: Callable[[Any], str]) -> Callable[[Any], str]:
+    # nchar(n) becomes CHAR(2n): PostgreSQL pads to 2n characters, pyodbc returns n
+    return lambda val: encode(val.rstrip(' '))
+
+def _normalizers(table_meta: Dict[str, Any], row_plan: RowPlan) -> List[Callable[[Any], str]]:
+    """Per-column text form used for hashing, the same for values read from either side"""
+    normalizers = list(row_plan.text_encoders)
+    for i, col in enumerate(table_meta['columns']):
+        pg_type = map_mssql_to_pg_type(col['type'], col['max_length'], col['precision'], col['scale'])
+        if pg_type == 'REAL':
+            normalizers[i] = _encode_real
+        elif pg_type.startswith('CHAR('):
+            normalizers[i] = _trim_padding(normalizers[i])
+    return normalizers
+
+def _row_text(normalizers: List[Callable[[Any], str]], row) -> str:
+    return '\t'.join([NULL if val is None else enc(val) for enc, val in zip(normalizers, row)])
+
+def _row_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+def _checksum_batch(normalizers, rows: List[tuple]) -> int:
+    total = 0
+    for row in rows:
+        total += _row_hash(_row_text(normalizers, row))
+    return total & _HASH_MASK
+
+class _Part:
+    """Rows of a key range whose key hash ends in bucket (its lowest bits bits)"""
+    def __init__(self, key_range: Optional[Tuple[Any, Any]], bits: int = 0, bucket: int = 0):
+        self.key_range = key_range
+        self.bits = bits
+        self.bucket = bucket
+
+    def split_by_hash(self) -> List['_Part']:
+        return [_Part(self.key_range, self.bits + _HASH_SPLIT_BITS, self.bucket | (child << self.bits))
+                for child in range(1 << _HASH_SPLIT_BITS)]
+
+def _row_key(normalizers, key_positions: List[int], row, text: str) -> str:
+    # Heaps have no key; the row itself identifies it
+    if not key_positions:
+        return text
+    return ', '.join(NULL if row[i] is None else normalizers[i](row[i]) for i in key_positions)
+
+def _digest_batch(normalizers, key_positions: List[int], part: _Part, rows: List[tuple]) -> List[Tuple[str, int]]:
+    """(key, row hash) of the rows that belong to part"""
+    mask = (1 << part.bits) - 1
+    digests = []
+    for row in rows:
+        text = _row_text(normalizers, row)
+        key = _row_key(normalizers, key_positions, row, text)
+        if part.bits and _row_hash(key) & mask != part.bucket:
+            continue
+        digests.append((key, _row_hash(text)))
+    return digests
+
+def _split_batch(normalizers, key_positions: List[int], part: _Part, rows: List[tuple],
+                 counts: List[int], sums: List[int]):
+    """Add the rows of part to per-child counts and hash sums of part.split_by_hash()"""
+    mask = (1 << part.bits) - 1
+    child_mask = (1 << _HASH_SPLIT_BITS) - 1
+    for row in rows:
+        text = _row_text(normalizers, row)
+        key_hash = _row_hash(_row_key(normalizers, key_positions, row, text))
+        if key_hash & mask != part.bucket:
+            continue
+        child = (key_hash >> part.bits) & child_mask
+        counts[child] += 1
+        sums[child] = (sums[child] + _row_hash(text)) & _HASH_MASK
+
+class _TableCheck:
+    """What both sides are read with for one table"""
+    def __init__(self, pg_conn, table_meta: Dict[str, Any], target_schema: str, row_plan: RowPlan,
+                 database: str):
+        self.pg_conn = pg_conn
+        self.table_meta = table_meta
+        self.target_schema = target_schema
+        self.row_plan = row_plan
+        self.database = database
+        self.normalizers = _normalizers(table_meta, row_plan)
+        self.key_columns = mssql_service.get_seek_columns(table_meta)
+        names = [col['name'] for col in table_meta['columns']]
+        self.key_positions = [names.index(k) for k in self.key_columns] if self.key_columns else []
+        # Whether key ranges select the same rows on both sides
+        self.range_key = bool(self.key_columns) and _range_key(
+            next(c for c in table_meta['columns'] if c['name'] == self.key_columns[0]))
+
+    def mssql_batches(self, key_range):
+        return mssql_service.iter_table_batches(self.table_meta, VALIDATE_BATCH_ROWS, key_range, self.database)
+
+    def pg_batches(self, key_range):
+        return postgres_service.stream_table_rows(
+            self.pg_conn, self.target_schema, self.table_meta['name'], self.row_plan.columns,
+            VALIDATE_BATCH_ROWS, self.key_columns[0] if self.key_columns else None, key_range
+        )
+
+async def _checksum(batches, normalizers) -> Tuple[int, int]:
+    """(row count, sum of row hashes) of a stream of batches"""
+    count = 0
+    total = 0
+    async for rows in batches:
+        count += len(rows)
+        total = (total + await asyncio.to_thread(_checksum_batch, normalizers, rows)) & _HASH_MASK
+    return count, total
+
+async def _checksum_range(check: _TableCheck, key_range) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """(row count, hash sum) of a key range on MSSQL and on PostgreSQL, both read at the same time"""
+    return await gather_or_cancel(
+        _checksum(check.mssql_batches(key_range), check.normalizers),
+        _checksum(check.pg_batches(key_range), check.normalizers)
+    )
+
+async def _split_checksums(batches, check: _TableCheck, part: _Part) -> Tuple[List[int], List[int]]:
+    """Per-child row counts and hash sums of part.split_by_hash() from a stream of batches"""
+    counts = [0] * (1 << _HASH_SPLIT_BITS)
+    sums = [0] * (1 << _HASH_SPLIT_BITS)
+    async for rows in batches:
+        await asyncio.to_thread(_split_batch, check.normalizers, check.key_positions, part, rows, counts, sums)
+    return counts, sums
+
+async def _compare_rows(check: _TableCheck, part: _Part) -> List[Dict[str, str]]:
+    """Compare a small part row by row"""
+    async def digests(batches) -> Counter:
+        found = Counter()
+        async for rows in batches:
+            found.update(await asyncio.to_thread(_digest_batch, check.normalizers, check.key_positions, part, rows))
+        return found
+    
+    source, target = await gather_or_cancel(digests(check.mssql_batches(part.key_range)),
+                                            digests(check.pg_batches(part.key_range)))
+    missing = {key for key, _ in source - target}
+    extra = {key for key, _ in target - source}
+    # A heap row is its own key, shortened for the report
+    bad = [{'key': key[:MAX_KEY_CHARS], 'problem': 'different'} for key in sorted(missing & extra)]
+    bad.extend({'key': key[:MAX_KEY_CHARS], 'problem': 'missing_in_pg'} for key in sorted(missing - extra))
+    bad.extend({'key': key[:MAX_KEY_CHARS], 'problem': 'extra_in_pg'} for key in sorted(extra - missing))
+    return bad
+
+async def _find_bad_keys(check: _TableCheck, part: _Part, mssql_rows: int, pg_rows: int,
+                         bad: List[Dict[str, str]]):
+    """Narrow a mismatching part down to differing keys, adding up to MAX_REPORTED_KEYS of them to bad"""
+    if len(bad) >= MAX_REPORTED_KEYS:
+        return
+    if max(mssql_rows, pg_rows) <= DRILL_DOWN_ROWS or part.bits + _HASH_SPLIT_BITS > 64:
+        bad.extend((await _compare_rows(check, part))[:MAX_REPORTED_KEYS - len(bad)])
+        return
+    
+    if not part.bits and check.range_key:
+        lo, hi = part.key_range or (None, None)
+        mid = await mssql_service.get_range_split_key(check.table_meta, part.key_range, max(mssql_rows // 2, 1),
+                                                      check.database)
+        # All rows on one leading key value (or none on MSSQL) cannot be split by range
+        if mid is not None and mid != hi:
+            for half in ((lo, mid), (mid, hi)):
+                (half_mssql_rows, mssql_sum), (half_pg_rows, pg_sum) = await _checksum_range(check, half)
+                if (half_mssql_rows, mssql_sum) != (half_pg_rows, pg_sum):
+                    await _find_bad_keys(check, _Part(half), half_mssql_rows, half_pg_rows, bad)
+            return
+    
+    # One more read of the range checksums every hash child of the part at once
+    (mssql_counts, mssql_sums), (pg_counts, pg_sums) = await gather_or_cancel(
+        _split_checksums(check.mssql_batches(part.key_range), check, part),
+        _split_checksums(check.pg_batches(part.key_range), check, part)
+    )
+    for child, child_part in enumerate(part.split_by_hash()):
+        if (mssql_counts[child], mssql_sums[child]) != (pg_counts[child], pg_sums[child]):
+            await _find_bad_keys(check, child_part, mssql_counts[child], pg_counts[child], bad)
+
+async def _plan_ranges(check: _TableCheck, row_count: int, chunk_rows: int) -> List[Optional[Tuple[Any, Any]]]:
+    partitions = min(MAX_RANGES_PER_TABLE, math.ceil(row_count / max(chunk_rows, 1)))
+    if partitions < 2 or not check.range_key:
+        return [None]
+    bounds = await mssql_service.get_key_range_bounds(check.table_meta, partitions, row_count, check.database)
+    return mssql_service.bounds_to_ranges(bounds) if bounds else [None]
+
+async def validate_table(pg_conn, table_meta: Dict[str, Any], target_schema: str, row_plan: RowPlan,
+                         row_count: int, chunk_rows: int, database: str) -> List[Dict[str, Any]]:
+    """
+    Checksum one table in key ranges of about chunk_rows rows.
+    Returns one result per range: range, mssql_rows, pg_rows, match, bad_keys
+    """
+    check = _TableCheck(pg_conn, table_meta, target_schema, row_plan, database)
+    results = []
+    for key_range in await _plan_ranges(check, row_count, chunk_rows):
+        (mssql_rows, mssql_sum), (pg_rows, pg_sum) = await _checksum_range(check, key_range)
+        match = mssql_rows == pg_rows and mssql_sum == pg_sum
+        bad_keys = []
+        if not match:
+            await _find_bad_keys(check, _Part(key_range), mssql_rows, pg_rows, bad_keys)
+            logger.warning(f"Checksum mismatch in {table_meta['name']} range {key_range}: "
+                           f"{mssql_rows} vs {pg_rows} rows, {len(bad_keys)} keys found")
+        results.append({
+            'range': key_range,
+            'mssql_rows': mssql_rows,
+            'pg_rows': pg_rows,
+            'match': match,
+            'bad_keys': bad_keys
+        })
+    return results
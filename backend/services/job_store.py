@@ -0,0 +1,371 @@
+"""
+Durable job repository.
+Jobs are stored as JSON with indexed status, created_at and backup hash
+columns, in SQLite by default or in PostgreSQL when JOB_STORE_URL is a
+postgresql:// URI. Running jobs are mutated in place by the pipeline and
+written behind: a background flusher saves changed jobs every
+JOB_STORE_FLUSH_SEC in one transaction, so progress updates never wait on
+the store. Reads go through a small in-memory LRU cache.
+Every process owns the jobs it started and heartbeats them; a queued or
+running job whose heartbeat is older than JOB_LEASE_SEC belongs to a process
+that is gone and is marked failed, so backends sharing one store never fail
+each other's live jobs.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from models.job import Job, JobStatus
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_URL = os.environ.get('JOB_STORE_URL') or f"sqlite:///{Path(__file__).parent.parent / 'jobs.db'}"
+JOB_STORE_FLUSH_SEC = float(os.environ.get('JOB_STORE_FLUSH_SEC', '1'))
+# Finished jobs kept in memory; queued and running jobs of this process always stay
+JOB_CACHE_SIZE = int(os.environ.get('JOB_CACHE_SIZE', '256'))
+# Active jobs not heartbeated for this long are taken over as failed
+JOB_LEASE_SEC = float(os.environ.get('JOB_LEASE_SEC', '30'))
+
+# Unique per process, so a restarted backend does not mistake old jobs for its own
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.RUNNING)
+
+# (job_id, status, created_at ISO, backup_sha256, owner, heartbeat_at, job JSON)
+Row = Tuple[str, str, str, Optional[str], str, float, str]
+
+class SqliteBackend:
+    """Jobs table in a local SQLite file; calls run in a thread"""
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _execute(self, query: str, params=(), many: bool = False) -> List[tuple]:
+        with self._lock:
+            if self._conn is None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            cursor = self._conn.executemany(query, params) if many else self._conn.execute(query, params)
+            rows = cursor.fetchall()
+            self._conn.commit()
+            return rows
+
+    async def init(self):
+        await asyncio.to_thread(self._execute, """CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at TEXT NOT NULL,
+            backup_sha256 TEXT, owner TEXT, heartbeat_at REAL, data TEXT NOT NULL)""")
+        # Tables created before leases lack the owner columns
+        columns = {row[1] for row in await asyncio.to_thread(self._execute, "PRAGMA table_info(jobs)")}
+        for column, column_type in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+            if column not in columns:
+                await asyncio.to_thread(self._execute, f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        for statement in (
+            "CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, created_at)",
+            "CREATE INDEX IF NOT EXISTS jobs_created_at_idx ON jobs (created_at)",
+            "CREATE INDEX IF NOT EXISTS jobs_backup_sha256_idx ON jobs (backup_sha256)",
+        ):
+            await asyncio.to_thread(self._execute, statement)
+
+    async def upsert(self, rows: List[Row]):
+        await asyncio.to_thread(self._execute, """
+            INSERT INTO jobs (job_id, status, created_at, backup_sha256, owner, heartbeat_at, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job_id) DO UPDATE SET status = excluded.status,
+                backup_sha256 = excluded.backup_sha256, owner = excluded.owner,
+                heartbeat_at = excluded.heartbeat_at, data = excluded.data""", rows, True)
+
+    async def heartbeat(self, owner: str, now: float, statuses: List[str]):
+        await asyncio.to_thread(
+            self._execute,
+            f"UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status IN ({', '.join('?' * len(statuses))})",
+            (now, owner, *statuses))
+
+    async def load(self, job_id: str) -> Optional[str]:
+        rows = await asyncio.to_thread(self._execute, "SELECT data FROM jobs WHERE job_id = ?", (job_id,))
+        return rows[0][0] if rows else None
+
+    async def query(self, statuses: Optional[List[str]], backup_sha256: Optional[str], limit: int) -> List[str]:
+        where, params = [], []
+        if statuses:
+            where.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if backup_sha256:
+            where.append("backup_sha256 = ?")
+            params.append(backup_sha256)
+        query = "SELECT data FROM jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        rows = await asyncio.to_thread(self._execute, query, (*params, limit))
+        return [row[0] for row in rows]
+
+    async def expired(self, statuses: List[str], before: float) -> List[str]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            f"SELECT data FROM jobs WHERE status IN ({', '.join('?' * len(statuses))}) "
+            f"AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+            (*statuses, before))
+        return [row[0] for row in rows]
+
+    async def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class PostgresBackend:
+    """Jobs table in PostgreSQL, for deployments running several backends"""
+    def __init__(self, uri: str):
+        self.uri = uri
+        self._conn = None  # psycopg.AsyncConnection
+        self._lock = asyncio.Lock()
+
+    async def _execute(self, query: str, params=(), many: bool = False) -> List[tuple]:
+        async with self._lock:
+            if self._conn is None or self._conn.closed:
+                # Imported here so SQLite deployments do not load the driver
+                import psycopg
+                self._conn = await psycopg.AsyncConnection.connect(self.uri, autocommit=True)
+            async with self._conn.cursor() as cursor:
+                if many:
+                    async with self._conn.transaction():
+                        await cursor.executemany(query, params)
+                    return []
+                await cursor.execute(query, params)
+                return await cursor.fetchall() if cursor.description else []
+
+    async def init(self):
+        for statement in (
+            """CREATE TABLE IF NOT EXISTS postgrator_jobs (
+                job_id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at TIMESTAMPTZ NOT NULL,
+                backup_sha256 TEXT, owner TEXT, heartbeat_at DOUBLE PRECISION, data JSONB NOT NULL)""",
+            "ALTER TABLE postgrator_jobs ADD COLUMN IF NOT EXISTS owner TEXT",
+            "ALTER TABLE postgrator_jobs ADD COLUMN IF NOT EXISTS heartbeat_at DOUBLE PRECISION",
+            "CREATE INDEX IF NOT EXISTS postgrator_jobs_status_idx ON postgrator_jobs (status, created_at)",
+            "CREATE INDEX IF NOT EXISTS postgrator_jobs_created_at_idx ON postgrator_jobs (created_at)",
+            "CREATE INDEX IF NOT EXISTS postgrator_jobs_backup_sha256_idx ON postgrator_jobs (backup_sha256)",
+        ):
+            await self._execute(statement)
+
+    async def upsert(self, rows: List[Row]):
+        await self._execute("""
+            INSERT INTO postgrator_jobs (job_id, status, created_at, backup_sha256, owner, heartbeat_at, data)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (job_id) DO UPDATE SET status = excluded.status,
+                backup_sha256 = excluded.backup_sha256, owner = excluded.owner,
+                heartbeat_at = excluded.heartbeat_at, data = excluded.data""", rows, True)
+
+    async def heartbeat(self, owner: str, now: float, statuses: List[str]):
+        await self._execute(
+            "UPDATE postgrator_jobs SET heartbeat_at = %s WHERE owner = %s AND status = ANY(%s)",
+            (now, owner, statuses))
+
+    async def load(self, job_id: str) -> Optional[str]:
+        rows = await self._execute("SELECT data::text FROM postgrator_jobs WHERE job_id = %s", (job_id,))
+        return rows[0][0] if rows else None
+
+    async def query(self, statuses: Optional[List[str]], backup_sha256: Optional[str], limit: int) -> List[str]:
+        where, params = [], []
+        if statuses:
+            where.append("status = ANY(%s)")
+            params.append(statuses)
+        if backup_sha256:
+            where.append("backup_sha256 = %s")
+            params.append(backup_sha256)
+        query = "SELECT data::text FROM postgrator_jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created_at DESC LIMIT %s"
+        rows = await self._execute(query, (*params, limit))
+        return [row[0] for row in rows]
+
+    async def expired(self, statuses: List[str], before: float) -> List[str]:
+        rows = await self._execute(
+            "SELECT data::text FROM postgrator_jobs WHERE status = ANY(%s) "
+            "AND (heartbeat_at IS NULL OR heartbeat_at < %s)", (statuses, before))
+        return [row[0] for row in rows]
+
+    async def close(self):
+        async with self._lock:
+            if self._conn is not None:
+                await self._conn.close()
+                self._conn = None
+
+def _create_backend(url: str):
+    if url.startswith(('postgresql://', 'postgres://')):
+        return PostgresBackend(url)
+    if url.startswith('sqlite:///'):
+        return SqliteBackend(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported JOB_STORE_URL: {url}")
+
+backend = _create_backend(JOB_STORE_URL)
+
+_cache: "OrderedDict[str, Job]" = OrderedDict()
+_dirty: set = set()
+# Jobs created or resumed by this process; only these are written while active
+_owned: set = set()
+# Digest of the last written JSON per job, so unchanged jobs are not rewritten
+_written: Dict[str, bytes] = {}
+_flusher: Optional[asyncio.Task] = None
+_heartbeat_at = 0.0
+
+def _is_live(job: Job) -> bool:
+    """Queued or running in this process"""
+    return job.job_id in _owned and job.status in ACTIVE_STATUSES
+
+def _cache_put(job: Job):
+    _cache[job.job_id] = job
+    _cache.move_to_end(job.job_id)
+    # Evict the oldest jobs that have been written and are not running here
+    for job_id in list(_cache):
+        if len(_cache) <= JOB_CACHE_SIZE:
+            break
+        cached = _cache[job_id]
+        if not _is_live(cached) and job_id not in _dirty:
+            del _cache[job_id]
+            _written.pop(job_id, None)
+            _owned.discard(job_id)
+
+def _to_row(job: Job, now: float) -> Row:
+    return (job.job_id, job.status.value, job.created_at.isoformat(), job.backup_sha256,
+            OWNER_ID, now, job.model_dump_json(by_alias=True))
+
+async def start():
+    """Create the table, fail jobs of processes that are gone and start the flusher"""
+    global _flusher
+    await backend.init()
+    await expire_leases()
+    if _flusher is None:
+        _flusher = asyncio.create_task(_flush_loop())
+
+async def stop():
+    """Stop the flusher and write everything still pending"""
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher = None
+    await flush()
+    await backend.close()
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(JOB_STORE_FLUSH_SEC)
+        try:
+            await flush()
+            await _heartbeat()
+        except Exception as e:
+            logger.warning(f"Job store flush failed: {e}")
+
+async def _heartbeat():
+    """Renew the lease on this process's active jobs and take over expired ones, a few times per lease"""
+    global _heartbeat_at
+    now = time.time()
+    if now - _heartbeat_at < JOB_LEASE_SEC / 3:
+        return
+    _heartbeat_at = now
+    await backend.heartbeat(OWNER_ID, now, [s.value for s in ACTIVE_STATUSES])
+    await expire_leases()
+
+async def expire_leases():
+    """Mark queued and running jobs whose owner stopped heartbeating as failed"""
+    expired = [Job.model_validate_json(data) for data in
+               await backend.expired([s.value for s in ACTIVE_STATUSES], time.time() - JOB_LEASE_SEC)]
+    expired = [job for job in expired if job.job_id not in _owned]
+    if not expired:
+        return
+    for job in expired:
+        job.status = JobStatus.FAILED
+        job.error = job.error or "Job'u çalıştıran sunucu durdu"
+        cached = _cache.get(job.job_id)
+        if cached is not None:
+            cached.status, cached.error = job.status, job.error
+    logger.info(f"Marked {len(expired)} jobs of stopped processes as failed")
+    await backend.upsert([_to_row(job, time.time()) for job in expired])
+
+async def flush():
+    """Write changed jobs (marked dirty, or active in this process) in one batch"""
+    jobs = [job for job in _cache.values() if job.job_id in _dirty or _is_live(job)]
+    _dirty.clear()
+    now = time.time()
+    rows = []
+    for job in jobs:
+        # Dumped on the loop: running jobs are mutated by it, a thread could see them half-updated
+        row = _to_row(job, now)
+        digest = hashlib.blake2b(row[6].encode(), digest_size=16).digest()
+        if _written.get(job.job_id) != digest:
+            rows.append(row)
+            _written[job.job_id] = digest
+    if not rows:
+        return
+    try:
+        await backend.upsert(rows)
+    except Exception:
+        # Written again on the next flush
+        for row in rows:
+            _written.pop(row[0], None)
+            _dirty.add(row[0])
+        raise
+
+def add(job: Job):
+    """Register a new job of this process; written by the next flush"""
+    _owned.add(job.job_id)
+    _cache_put(job)
+    _dirty.add(job.job_id)
+
+def mark_dirty(job: Job):
+    """
+    Schedule a write of a job changed outside its run (e.g. finished, or queued
+    for resume); this process takes the job over
+    """
+    _owned.add(job.job_id)
+    _cache_put(job)
+    _dirty.add(job.job_id)
+
+async def get(job_id: str) -> Optional[Job]:
+    """
+    Job by ID from the cache, falling back to the store. Active jobs of other
+    processes are always read from the store, their cached copy goes stale
+    """
+    job = _cache.get(job_id)
+    if job is not None and (job_id in _owned or job.status not in ACTIVE_STATUSES):
+        _cache.move_to_end(job_id)
+        return job
+    data = await backend.load(job_id)
+    if data is None:
+        return None
+    loaded = Job.model_validate_json(data)
+    # Another request may have taken the job over meanwhile; keep that copy
+    current = _cache.get(job_id)
+    if current is not None and job_id in _owned:
+        return current
+    _cache_put(loaded)
+    return loaded
+
+async def list_jobs(status: Optional[JobStatus] = None, backup_sha256: Optional[str] = None,
+                    limit: int = 50) -> List[Job]:
+    """Newest jobs first, optionally by status and backup hash; this process's jobs are returned as in memory"""
+    await flush()
+    data = await backend.query([status.value] if status else None, backup_sha256, limit)
+    jobs = []
+    for item in data:
+        job = Job.model_validate_json(item)
+        jobs.append(_cache[job.job_id] if job.job_id in _owned and job.job_id in _cache else job)
+    return jobs
+
+def stats() -> Dict[str, int]:
+    return {'cached': len(_cache), 'dirty': len(_dirty), 'owned': len(_owned), 'maxCached': JOB_CACHE_SIZE}
@@ -1,98 +1,551 @@
 import asyncio
+import contextlib
 import logging
 from pathlib import Path
 import time
-from typing import Dict
+import math
+from typing import List, Optional
 import json
 import csv
 import io
+from datetime import datetime, timezone
 
 from models.job import Job, JobStatus, Stage, TableInfo
 from utils.websocket_manager import manager
+from utils.tasks import gather_or_cancel
+from services.batch_sizer import BatchSizer, batch_budget_bytes
+from services import checkpoint, job_store, scheduler, schema_cache
 
 # Lazy imports to avoid loading heavy dependencies when not needed
 mssql_service = None
 postgres_service = None
 upload_service = None
+copy_pipeline = None
+row_encoder = None
+restore_cache = None
+data_validator = None
 
 def _ensure_services():
     """Lazy load services only when needed for real migration"""
-    global mssql_service, postgres_service, upload_service
+    global mssql_service, postgres_service, upload_service, copy_pipeline, row_encoder, restore_cache, data_validator
     if mssql_service is None:
         from services import mssql_service as ms
         from services import postgres_service as ps
         from services import upload_service as us
+        from services import copy_pipeline as cp
+        from services import row_encoder as rp
+        from services import restore_cache as rc
+        from services import data_validator as dv
         mssql_service = ms
         postgres_service = ps
         upload_service = us
+        copy_pipeline = cp
+        row_encoder = rp
+        restore_cache = rc
+        data_validator = dv
 
 logger = logging.getLogger(__name__)
 
-# In-memory job storage (for MVP; production would use database)
-jobs: Dict[str, Job] = {}
+_expirer: Optional[asyncio.Task] = None
 
-async def create_job(pg_uri: str, schema: str, bak_filename: str, is_demo: bool = False) -> str:
-    """Create a new migration job"""
+async def create_job(pg_uri: str, schema: str, bak_filename: str, is_demo: bool = False, **options) -> str:
+    """
+    Create a new migration job
+    options: per-job tuning fields of Job (batch_size, batch_memory_mb, queue_depth,
+             parallelism, partition_rows, copy_format, fast_load, index_parallelism,
+             maintenance_work_mem_mb, max_parallel_maintenance_workers, exact_row_counts,
+             validation_mode, validate_chunk_rows, priority)
+    """
     job = Job(
         pg_uri=pg_uri,
         schema=schema,
         bak_filename=bak_filename,
-        is_demo=is_demo
+        is_demo=is_demo,
+        **options
     )
-    jobs[job.job_id] = job
+    job_store.add(job)
     return job.job_id
 
-def get_job(job_id: str) -> Job:
+async def get_job(job_id: str) -> Optional[Job]:
     """Get job by ID"""
-    return jobs.get(job_id)
+    return await job_store.get(job_id)
+
+async def list_jobs(status: Optional[JobStatus] = None, backup_sha256: Optional[str] = None,
+                    limit: int = 50) -> List[Job]:
+    """Newest jobs first, optionally filtered by status and backup hash"""
+    return await job_store.list_jobs(status, backup_sha256, limit)
+
+async def prepare_resume(job_id: str) -> Optional[Job]:
+    """
+    Queue a failed job to continue from its checkpoint; a job missing from the
+    store is restored from the checkpoint. Returns None if there is no
+    checkpoint, raises ValueError if the job has not failed
+    """
+    saved = checkpoint.load(job_id)
+    if saved is None:
+        return None
+    job = await job_store.get(job_id)
+    if job is None:
+        job = Job.model_validate(saved['job'])
+    elif job.status != JobStatus.FAILED:
+        raise ValueError(f"Job {job_id} is {job.status.value}")
+    job.status = JobStatus.QUEUED
+    job.error = None
+    job.completed_at = None
+    job_store.mark_dirty(job)
+    return job
+
+async def expire_checkpoints():
+    """
+    Forget failed jobs not resumed within CHECKPOINT_TTL_SEC: delete their checkpoint
+    and drop the restored database each one kept for a resume
+    """
+    for job_id in await asyncio.to_thread(checkpoint.expired):
+        job = await job_store.get(job_id)
+        if job is not None and job.status in job_store.ACTIVE_STATUSES:
+            continue
+        _ensure_services()
+        await mssql_service.drop_database(mssql_service.job_database_name(job_id))
+        checkpoint.delete(job_id)
+        logger.info(f"Checkpoint of job {job_id} expired, its restored database was dropped")
+
+async def start():
+    """Expire old checkpoints now and then hourly"""
+    global _expirer
+    if _expirer is None:
+        _expirer = asyncio.create_task(_expire_loop())
+
+async def stop():
+    global _expirer
+    if _expirer is not None:
+        _expirer.cancel()
+        try:
+            await _expirer
+        except asyncio.CancelledError:
+            pass
+        _expirer = None
+
+async def _expire_loop():
+    while True:
+        try:
+            await expire_checkpoints()
+        except Exception as e:
+            logger.warning(f"Checkpoint expiry failed: {e}")
+        await asyncio.sleep(3600)
 
 async def send_progress(job_id: str, event_type: str, **kwargs):
     """Send progress update via WebSocket"""
     await manager.send_event(job_id, event_type, kwargs)
 
-async def run_migration(job_id: str):
+class _TableCopy:
+    """Shared state of one table whose key ranges may be copied by several workers"""
+    def __init__(self, table_meta: dict, table_info: TableInfo, ranges: list, row_plan, binary: bool,
+                 disk_row_bytes=None):
+        self.table_meta = table_meta
+        self.table_info = table_info
+        self.ranges = ranges
+        self.row_plan = row_plan
+        self.binary = binary
+        self.disk_row_bytes = disk_row_bytes
+        self.range_rows = [0] * len(ranges)
+        self.remaining = len(ranges)
+        self.started_at = None
+
+def _table_key(table_meta: dict) -> str:
+    return f"{table_meta['schema']}.{table_meta['name']}"
+
+# Leading key types that compare the same in MSSQL and PostgreSQL, so deleting a
+# key range in PostgreSQL removes exactly the rows copied from it (collations and
+# uniqueidentifier order differ between the two)
+_RESUMABLE_KEY_TYPES = {'tinyint', 'smallint', 'int', 'bigint', 'decimal', 'numeric'}
+
+def _ranges_resumable(table_meta: dict) -> bool:
+    """True if a half-copied table can be resumed range by range"""
+    key_columns = mssql_service.get_seek_columns(table_meta)
+    if not key_columns:
+        return False
+    key_col = next(c for c in table_meta['columns'] if c['name'] == key_columns[0])
+    return key_col['type'].lower() in _RESUMABLE_KEY_TYPES
+
+async def _plan_table_copies(job: Job, schema_info: dict, ckpt: checkpoint.Checkpoint) -> List[_TableCopy]:
+    """
+    Split tables above job.partition_rows into primary-key ranges so that
+    one huge table is copied by several workers, and pick each table's COPY format.
+    Ranges are recorded in the checkpoint; a resumed job reuses them
+    """
+    plans = []
+    for table_meta, table_info in zip(schema_info['tables'], job.tables):
+        # Column converters are resolved once per table and shared by all its ranges
+        row_plan = row_encoder.build_row_plan(table_meta)
+        binary = job.copy_format == "binary" and row_plan.binary_types is not None
+        if job.copy_format == "binary" and not binary:
+            logger.info(f"{table_meta['name']} has columns without a binary mapping, using text COPY")
+        table_info.copy_format = "binary" if binary else "text"
+        
+        ranges = ckpt.table_ranges(_table_key(table_meta)) or [None]
+        partitions = min(job.parallelism, math.ceil(table_info.row_count / job.partition_rows))
+        if partitions > 1 and ckpt.table_ranges(_table_key(table_meta)) is None:
+            try:
+                bounds = await mssql_service.get_key_range_bounds(
+                    table_meta, partitions, table_info.row_count, job.source_database
+                )
+                if bounds:
+                    ranges = mssql_service.bounds_to_ranges(bounds)
+                    logger.info(f"Splitting {table_meta['schema']}.{table_meta['name']} into {len(ranges)} key ranges")
+            except Exception as e:
+                logger.warning(f"Could not split {table_meta['name']} into key ranges: {e}")
+        # Adaptive batches start from the stored row width
+        disk_row_bytes = None
+        if table_info.data_bytes and table_info.row_count > 0:
+            disk_row_bytes = table_info.data_bytes / table_info.row_count
+        
+        ckpt.set_table_ranges(_table_key(table_meta), ranges)
+        plans.append(_TableCopy(table_meta, table_info, ranges, row_plan, binary, disk_row_bytes))
+    await ckpt.save(force=True)
+    return plans
+
+async def _copy_table_range(job: Job, pg_conn, table_copy: _TableCopy, range_idx: int):
+    """Copy one key range of a table, rolling its progress up into the table's events"""
+    job_id = job.job_id
+    table_info = table_copy.table_info
+    table_name = table_copy.table_meta['name']
+    total_rows = table_info.row_count
+    
+    if table_copy.started_at is None:
+        table_copy.started_at = time.time()
+        await send_progress(job_id, "log", level="info", msg=f"Kopyalanıyor: {table_name}")
+    
+    async def report_progress(copied_rows: int):
+        table_copy.range_rows[range_idx] = copied_rows
+        table_info.migrated_rows = sum(table_copy.range_rows)
+        # Row counts from partition stats are approximate and may be 0 for a non-empty table
+        table_info.percent = min(100, int((table_info.migrated_rows / total_rows) * 100)) if total_rows else 0
+        await send_progress(job_id, "table_progress",
+            table=table_name,
+            rows=table_info.migrated_rows,
+            total=total_rows,
+            percent=table_info.percent
+        )
+    
+    batch_sizer = BatchSizer(
+        batch_budget_bytes(job.batch_memory_mb, job.parallelism, job.queue_depth),
+        disk_row_bytes=table_copy.disk_row_bytes,
+        fixed_rows=job.batch_size
+    )
+    
+    # Read, encode and COPY run as overlapping pipeline stages
+    copied_rows = await copy_pipeline.copy_table(
+        pg_conn, table_copy.table_meta, job.schema,
+        batch_sizer, job.queue_depth,
+        job.stats.pipeline, report_progress,
+        key_range=table_copy.ranges[range_idx],
+        row_plan=table_copy.row_plan,
+        binary=table_copy.binary,
+        commit_each_batch=not job.fast_load,
+        database=job.source_database
+    )
+    job.stats.rows_migrated += copied_rows
+    table_info.avg_row_bytes = round(batch_sizer.avg_row_bytes, 1)
+    
+    table_copy.remaining -= 1
+    if table_copy.remaining == 0:
+        table_info.copied = True
+        table_info.percent = 100
+        table_info.duration_sec = time.time() - table_copy.started_at
+        job.stats.tables_done += 1
+        
+        # Update overall progress
+        job.percent = 45 + int((job.stats.tables_done / job.stats.tables_total) * 30)
+
+async def _copy_tables(job: Job, schema_info: dict, pg_conn, ckpt: checkpoint.Checkpoint):
+    """
+    Copy all tables with job.parallelism workers, each on its own PG connection
+    and MSSQL reader. Tables have no constraints yet, so load order does not matter;
+    ranges of a split table share the same target table.
+    Ranges the checkpoint records as committed are skipped.
+    """
+    plans = await _plan_table_copies(job, schema_info, ckpt)
+    job.stats.rows_migrated = 0
+    job.stats.tables_done = 0
+    pending = []
+    
+    # Every range writes into the table, so clear them all before any worker starts
+    for plan in plans:
+        table_name = plan.table_meta['name']
+        table_info = plan.table_info
+        done = ckpt.done_ranges(_table_key(plan.table_meta))
+        if done and len(done) < len(plan.ranges) and not _ranges_resumable(plan.table_meta):
+            logger.info(f"{table_name} key ranges select different rows in PostgreSQL, copying it again")
+            done = {}
+        if done and job.fast_load and not await postgres_service.table_has_rows(pg_conn, job.schema, table_name):
+            # PostgreSQL empties UNLOGGED tables after a crash, committed ranges are gone too
+            logger.info(f"{table_name} was emptied since the checkpoint, copying it again")
+            done = {}
+        if not done:
+            ckpt.reset_table(_table_key(plan.table_meta))
+        todo = [idx for idx in range(len(plan.ranges)) if idx not in done]
+        
+        for idx, rows in done.items():
+            plan.range_rows[idx] = rows
+        plan.remaining = len(todo)
+        table_info.migrated_rows = sum(plan.range_rows)
+        job.stats.rows_migrated += table_info.migrated_rows
+        
+        if not todo:
+            table_info.copied = True
+            table_info.percent = 100
+            job.stats.tables_done += 1
+            continue
+        table_info.copied = False
+        
+        if not done:
+            await postgres_service.truncate_table(pg_conn, job.schema, table_name)
+        else:
+            # Rows of unfinished ranges may be partly committed
+            key_column = mssql_service.get_seek_columns(plan.table_meta)[0]
+            for idx in todo:
+                await postgres_service.delete_key_range(pg_conn, job.schema, table_name, key_column, plan.ranges[idx])
+            logger.info(f"Resuming {table_name}: {len(done)}/{len(plan.ranges)} ranges already copied")
+        if job.fast_load:
+            # Tables left over from an earlier import may still be LOGGED
+            await postgres_service.set_table_logged(pg_conn, job.schema, table_name, False)
+        pending.extend((plan, idx) for idx in todo)
+    
+    # Largest units first so a big table does not start last and run alone
+    pending.sort(key=lambda unit: unit[0].table_info.row_count / len(unit[0].ranges), reverse=True)
+    active = {}
+    
+    async def worker():
+        pg_conn = await postgres_service.get_pg_connection(job.pg_uri)
+        try:
+            while pending:
+                table_copy, range_idx = pending.pop(0)
+                table_key = f"{table_copy.table_meta['schema']}.{table_copy.table_meta['name']}"
+                active[table_key] = active.get(table_key, 0) + 1
+                job.stats.current_table = ', '.join(sorted(active))
+                try:
+                    await _copy_table_range(job, pg_conn, table_copy, range_idx)
+                    await ckpt.range_done(table_key, range_idx, table_copy.range_rows[range_idx])
+                finally:
+                    active[table_key] -= 1
+                    if not active[table_key]:
+                        del active[table_key]
+        finally:
+            await pg_conn.close()
+    
+    workers = max(1, min(job.parallelism, len(pending)))
+    await gather_or_cancel(*[worker() for _ in range(workers)])
+    job.stats.current_table = None
+    job.percent = 75
+
+async def _count_rows_exactly(job: Job):
+    """Replace metadata row counts with COUNT(*), job.parallelism tables at a time"""
+    started = time.time()
+    limit = asyncio.Semaphore(job.parallelism)
+    
+    async def count(table_info: TableInfo):
+        async with limit:
+            exact = await mssql_service.get_table_row_count(
+                table_info.schema_name, table_info.table_name, job.source_database
+            )
+        if exact is None:
+            return
+        if exact != table_info.row_count:
+            logger.info(f"{table_info.table_name}: metadata row count {table_info.row_count}, exact {exact}")
+        table_info.row_count = exact
+        table_info.row_count_exact = True
+    
+    await gather_or_cancel(*[count(t) for t in job.tables])
+    job.stats.stage_durations['exact_row_counts'] = time.time() - started
+
+async def _validate_checksums(job: Job, schema_info: dict, artifacts_dir: Path) -> bool:
+    """
+    Compare row checksums of every table in key ranges, job.parallelism tables
+    at a time, each on its own PG connection. Writes checksum.csv.
+    Returns True if all ranges match
+    """
+    pending = sorted(zip(schema_info['tables'], job.tables), key=lambda t: t[1].row_count, reverse=True)
+    report = []
+    
+    async def worker():
+        pg_conn = await postgres_service.get_pg_connection(job.pg_uri)
+        try:
+            while pending:
+                table_meta, table_info = pending.pop(0)
+                results = await data_validator.validate_table(
+                    pg_conn, table_meta, job.schema, row_encoder.build_row_plan(table_meta),
+                    table_info.row_count, job.validate_chunk_rows, job.source_database
+                )
+                mismatched = sum(1 for result in results if not result['match'])
+                if mismatched:
+                    table_info.error = '; '.join(filter(None, [
+                        table_info.error, f"Checksum uyuşmuyor: {mismatched}/{len(results)} aralık"
+                    ]))
+                for result in results:
+                    lo, hi = result['range'] or (None, None)
+                    report.append({
+                        'table': table_info.table_name,
+                        'range_start': '' if lo is None else lo,
+                        'range_end': '' if hi is None else hi,
+                        'mssql_rows': result['mssql_rows'],
+                        'pg_rows': result['pg_rows'],
+                        'match': result['match'],
+                        'mismatched_keys': '; '.join(f"{bad['key']} ({bad['problem']})" for bad in result['bad_keys'])
+                    })
+        finally:
+            await pg_conn.close()
+    
+    workers = max(1, min(job.parallelism, len(pending)))
+    await gather_or_cancel(*[worker() for _ in range(workers)])
+    
+    with open(artifacts_dir / "checksum.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['table', 'range_start', 'range_end', 'mssql_rows', 'pg_rows',
+                                               'match', 'mismatched_keys'])
+        writer.writeheader()
+        writer.writerows(report)
+    
+    return all(row['match'] for row in report)
+
+async def _build_in_parallel(job: Job, statements: List[tuple], workers: Optional[int] = None) -> List[dict]:
+    """
+    Run (table name, SQL) statements on job.index_parallelism connections,
+    largest table first so the longest build does not start last
+    """
+    workers = workers or job.index_parallelism
+    sizes = {t.table_name: t.row_count * (t.avg_row_bytes or 1) for t in job.tables}
+    statements = sorted(statements, key=lambda stmt: sizes.get(stmt[0], 0), reverse=True)
+    
+    started = time.time()
+    results = await postgres_service.run_statements_parallel(
+        job.pg_uri, statements, workers,
+        job.maintenance_work_mem_mb, job.max_parallel_maintenance_workers
+    )
+    failed = [r for r in results if r['error']]
+    logger.info(f"Ran {len(results) - len(failed)}/{len(statements)} in {time.time() - started:.1f}s "
+                f"on {workers} connections")
+    for result in failed:
+        await send_progress(job.job_id, "log", level="warning", msg=f"⚠ Uygulanamadı: {result['sql']} ({result['error']})")
+    return results
+
+async def _apply_foreign_keys(job: Job, schema_info: dict, artifacts_dir: Path, existing: set):
+    """
+    Add foreign keys as NOT VALID (no scan, brief locks), then validate them
+    concurrently. Keys in existing (added by an earlier run) are only validated,
+    which is a no-op for ones that are already valid.
+    Per-constraint timings go to fk_validation.csv
+    """
+    foreign_keys = postgres_service.foreign_key_statements(schema_info, job.schema, not_valid=True)
+    
+    # One connection: adds lock both tables, so concurrent adds could deadlock
+    added = await _build_in_parallel(job, [(table, fk_sql) for table, fk_name, fk_sql in foreign_keys
+                                           if fk_name not in existing], workers=1)
+    add_errors = {r['sql']: r['error'] for r in added}
+    
+    # VALIDATE only takes SHARE UPDATE EXCLUSIVE, so writes and other validations can proceed
+    validations = {
+        postgres_service.validate_constraint_sql(job.schema, table, fk_name): (table, fk_name)
+        for table, fk_name, fk_sql in foreign_keys if not add_errors.get(fk_sql)
+    }
+    validated = await _build_in_parallel(job, [(table, sql) for sql, (table, _) in validations.items()])
+    
+    report = []
+    for table, fk_name, fk_sql in foreign_keys:
+        if add_errors.get(fk_sql):
+            report.append({'table': table, 'constraint': fk_name, 'status': 'add_failed',
+                           'duration_sec': '', 'error': add_errors[fk_sql]})
+    for result in validated:
+        report.append({
+            'table': result['table'],
+            'constraint': validations[result['sql']][1],
+            'status': 'invalid' if result['error'] else 'valid',
+            'duration_sec': round(result['duration_sec'], 3),
+            'error': result['error'] or ''
+        })
+    
+    with open(artifacts_dir / "fk_validation.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['table', 'constraint', 'status', 'duration_sec', 'error'])
+        writer.writeheader()
+        writer.writerows(report)
+    
+    invalid = sum(1 for row in report if row['status'] != 'valid')
+    if invalid:
+        await send_progress(job.job_id, "log", level="warning",
+            msg=f"⚠ {invalid} foreign key doğrulanamadı (fk_validation.csv)")
+
+async def run_migration(job_id: str, resume: bool = False):
     """
     Main migration pipeline
+    resume=True continues a failed job from its checkpoint, skipping finished stages
     """
     _ensure_services()  # Load services when needed
     
-    job = jobs.get(job_id)
+    job = await job_store.get(job_id)
     if not job:
         return
     
     start_time = time.time()
+    exact_counts = None
+    lease = None
+    ckpt = checkpoint.Checkpoint(job, checkpoint.load(job_id) if resume else None)
+    artifacts_dir = Path(f"/app/artifacts/{job_id}")
     
     try:
-        job.status = JobStatus.RUNNING
-        await send_progress(job_id, "log", level="info", msg="Migrasyon başlatıldı")
-        
-        # Stage 1: Verify
-        job.stage = Stage.VERIFY
-        job.percent = 5
-        await send_progress(job_id, "stage", v="verify")
-        await send_progress(job_id, "log", level="info", msg=".bak dosyası doğrulanıyor...")
-        
-        # Get Docker path for MSSQL to access the file
-        docker_bak_path = upload_service.get_docker_backup_path(job_id)
-        if not docker_bak_path:
-            raise Exception("Backup dosyası bulunamadı")
-        
-        logger.info(f"Docker backup path: {docker_bak_path}")
+        await ckpt.mark_stage('started')
+        # A backup restored by an earlier job is reused as is, otherwise the job
+        # restores into a database of its own. Waiting here for another job's
+        # restore of the same backup does not take a restore slot
+        lease = await restore_cache.acquire(job.backup_sha256, mssql_service.job_database_name(job_id),
+                                            reuse_temp=ckpt.reached('restored'))
+        job.source_database = lease.database
         
-        # Verify backup
-        await mssql_service.verify_backup(docker_bak_path)
-        await send_progress(job_id, "log", level="info", msg="✓ Backup doğrulandı")
-        
-        # Stage 2: Restore
-        job.stage = Stage.RESTORE
-        job.percent = 15
-        await send_progress(job_id, "stage", v="restore")
-        await send_progress(job_id, "log", level="info", msg="MSSQL'e restore ediliyor...")
-        
-        # Get file list
-        logical_files = await mssql_service.get_backup_file_list(docker_bak_path)
-        await mssql_service.restore_database(docker_bak_path, logical_files)
-        await send_progress(job_id, "log", level="info", msg="✓ Database restore edildi")
+        # The job stays QUEUED until a restore slot is free; a warm database needs none
+        async with contextlib.nullcontext() if lease.warm else scheduler.slot('restore', job):
+            job.status = JobStatus.RUNNING
+            if ckpt.reached('restored'):
+                await send_progress(job_id, "log", level="info",
+                    msg=f"Migrasyon kaldığı yerden devam ediyor ({ckpt.data['stage']})")
+            else:
+                await send_progress(job_id, "log", level="info", msg="Migrasyon başlatıldı")
+            
+            # Stage 1: Verify
+            job.stage = Stage.VERIFY
+            job.percent = 5
+            await send_progress(job_id, "stage", v="verify")
+            await send_progress(job_id, "log", level="info", msg=".bak dosyası doğrulanıyor...")
+            
+            # Get Docker path for MSSQL to access the file
+            docker_bak_path = upload_service.get_docker_backup_path(job_id)
+            if not docker_bak_path:
+                raise Exception("Backup dosyası bulunamadı")
+            
+            logger.info(f"Docker backup path: {docker_bak_path}")
+            
+            # Verify backup
+            if not lease.warm:
+                await mssql_service.verify_backup(docker_bak_path)
+            await send_progress(job_id, "log", level="info", msg="✓ Backup doğrulandı")
+            
+            # Stage 2: Restore
+            job.stage = Stage.RESTORE
+            job.percent = 15
+            await send_progress(job_id, "stage", v="restore")
+            
+            if lease.warm:
+                await send_progress(job_id, "log", level="info",
+                    msg=f"✓ Backup daha önce restore edilmiş, {lease.database} kullanılıyor")
+            else:
+                await send_progress(job_id, "log", level="info", msg="MSSQL'e restore ediliyor...")
+                restore_start = time.time()
+                
+                # Get file list
+                logical_files = await mssql_service.get_backup_file_list(docker_bak_path)
+                restored_bytes = sum(lf['size'] for lf in logical_files)
+                await restore_cache.make_room(lease, restored_bytes)
+                await mssql_service.restore_database(docker_bak_path, logical_files, lease.database)
+                await restore_cache.ready(lease, restored_bytes)
+                job.stats.stage_durations['restore'] = time.time() - restore_start
+                await send_progress(job_id, "log", level="info", msg="✓ Database restore edildi")
+            await ckpt.mark_stage('restored')
         
         # Stage 3: Schema Discovery
         job.stage = Stage.SCHEMA_DISCOVERY
@@ -100,16 +553,49 @@ async def run_migration(job_id: str):
         await send_progress(job_id, "stage", v="schema_discovery")
         await send_progress(job_id, "log", level="info", msg="Şema analiz ediliyor...")
         
-        schema_info = await mssql_service.discover_schema()
+        discovery_start = time.time()
+        cache_entry = None
+        if ckpt.reached('schema_discovered'):
+            # job.tables came back with the job
+            schema_info = await ckpt.load_schema()
+        elif cache_entry := await asyncio.to_thread(schema_cache.get, job.backup_sha256):
+            job.stats.cache_hits += 1
+            schema_info = cache_entry['schema_info']
+            sizes = {(schema, table): size for schema, table, size in cache_entry['table_sizes']}
+            await send_progress(job_id, "log", level="info", msg="✓ Şema önbellekten alındı")
+        else:
+            job.stats.cache_misses += 1
+            schema_info = await mssql_service.discover_schema(job.source_database)
+            # Row counts and sizes from partition stats (one query, no table scans)
+            sizes = await mssql_service.get_table_sizes(job.source_database)
+            cache_entry = {
+                'schema_info': schema_info,
+                'table_sizes': [[schema, table, size] for (schema, table), size in sizes.items()],
+                'ddl': {}
+            }
+            await asyncio.to_thread(schema_cache.put, job.backup_sha256, cache_entry)
         
-        # Initialize table list
-        for table in schema_info['tables']:
-            row_count = await mssql_service.get_table_row_count(table['schema'], table['name'])
-            job.tables.append(TableInfo(
-                schema_name=table['schema'],
-                table_name=table['name'],
-                row_count=row_count
-            ))
+        if not ckpt.reached('schema_discovered'):
+            job.stats.stage_durations['schema_discovery'] = time.time() - discovery_start
+            logger.info(f"Schema discovery took {job.stats.stage_durations['schema_discovery']:.1f}s")
+            
+            # Initialize table list
+            job.tables = []
+            for table in schema_info['tables']:
+                size = sizes.get((table['schema'], table['name']), {})
+                job.tables.append(TableInfo(
+                    schema_name=table['schema'],
+                    table_name=table['name'],
+                    row_count=size.get('rows', 0),
+                    data_bytes=size.get('data_bytes'),
+                    reserved_bytes=size.get('reserved_bytes')
+                ))
+            await ckpt.save_schema(schema_info)
+            await ckpt.mark_stage('schema_discovered')
+        
+        if job.exact_row_counts and not all(t.row_count_exact for t in job.tables):
+            # Runs alongside DDL and the data copy, awaited before validation
+            exact_counts = asyncio.create_task(_count_rows_exactly(job))
         
         job.stats.tables_total = len(job.tables)
         await send_progress(job_id, "log", level="info", msg=f"✓ {len(job.tables)} tablo bulundu")
@@ -123,13 +609,25 @@ async def run_migration(job_id: str):
         pg_conn = await postgres_service.get_pg_connection(job.pg_uri)
         
         try:
-            await postgres_service.create_schema(pg_conn, job.schema)
-            ddl_sql = await postgres_service.generate_and_apply_ddl(pg_conn, schema_info, job.schema)
-            
-            # Save DDL to file
-            artifacts_dir = Path(f"/app/artifacts/{job_id}")
             artifacts_dir.mkdir(parents=True, exist_ok=True)
-            (artifacts_dir / "schema.sql").write_text(ddl_sql)
+            if not ckpt.reached('ddl_applied'):
+                await postgres_service.create_schema(pg_conn, job.schema)
+                # Generated DDL depends on the target schema and table kind
+                ddl_variant = f"{job.schema}:{'unlogged' if job.fast_load else 'logged'}"
+                ddl_statements = cache_entry['ddl'].get(ddl_variant) if cache_entry else None
+                if ddl_statements:
+                    job.stats.cache_hits += 1
+                else:
+                    job.stats.cache_misses += 1
+                    ddl_statements = postgres_service.generate_ddl(schema_info, job.schema, unlogged=job.fast_load)
+                    if cache_entry:
+                        cache_entry['ddl'][ddl_variant] = ddl_statements
+                        await asyncio.to_thread(schema_cache.put, job.backup_sha256, cache_entry)
+                ddl_sql = await postgres_service.apply_ddl(pg_conn, ddl_statements)
+                
+                # Save DDL to file
+                (artifacts_dir / "schema.sql").write_text(ddl_sql)
+                await ckpt.mark_stage('ddl_applied')
             
             await send_progress(job_id, "log", level="info", msg="✓ Tablolar oluşturuldu")
             
@@ -138,69 +636,50 @@ async def run_migration(job_id: str):
             job.percent = 45
             await send_progress(job_id, "stage", v="data_copy")
             
-            batch_size = 10000
+            if not ckpt.reached('data_copied'):
+                async with scheduler.slot('copy', job):
+                    wal_start = await postgres_service.get_wal_lsn(pg_conn)
+                    await _copy_tables(job, schema_info, pg_conn, ckpt)
+                    job.stats.wal_bytes['data_copy'] = await postgres_service.get_wal_bytes_since(pg_conn, wal_start)
+                    
+                    await send_progress(job_id, "log", level="info", msg="✓ Tüm veriler kopyalandı")
+                    for stage, timing in job.stats.pipeline.items():
+                        logger.info(f"Pipeline stage {stage}: busy {timing.busy_sec:.1f}s, idle {timing.idle_sec:.1f}s")
+                    
+                    if job.fast_load:
+                        # Tables must be crash-safe before constraints are built on them
+                        await send_progress(job_id, "log", level="info", msg="Tablolar LOGGED moda alınıyor...")
+                        wal_start = await postgres_service.get_wal_lsn(pg_conn)
+                        for table_meta in schema_info['tables']:
+                            await postgres_service.set_table_logged(pg_conn, job.schema, table_meta['name'], True)
+                        job.stats.wal_bytes['set_logged'] = await postgres_service.get_wal_bytes_since(pg_conn, wal_start)
+                    await ckpt.mark_stage('data_copied')
             
-            for idx, table_meta in enumerate(schema_info['tables']):
-                table_name = table_meta['name']
-                schema_name = table_meta['schema']
-                job.stats.current_table = f"{schema_name}.{table_name}"
-                
-                await send_progress(job_id, "log", level="info", msg=f"Kopyalanıyor: {table_name}")
-                
-                # Truncate table
-                await postgres_service.truncate_table(pg_conn, job.schema, table_name)
-                
-                # Get columns
-                columns = [col['name'] for col in table_meta['columns']]
-                
-                # Copy data in batches
-                offset = 0
-                table_job_info = job.tables[idx]
-                total_rows = table_job_info.row_count
-                
-                if total_rows > 0:
-                    while offset < total_rows:
-                        rows = await mssql_service.fetch_table_data_batch(
-                            schema_name, table_name, columns, offset, batch_size
-                        )
-                        
-                        if rows:
-                            await postgres_service.copy_data_to_table(
-                                pg_conn, job.schema, table_name, columns, rows
-                            )
-                        
-                        offset += batch_size
-                        
-                        # Progress update
-                        progress = min(100, int((offset / total_rows) * 100))
-                        await send_progress(job_id, "table_progress",
-                            table=table_name,
-                            rows=min(offset, total_rows),
-                            total=total_rows,
-                            percent=progress
-                        )
-                
-                table_job_info.copied = True
-                job.stats.tables_done += 1
-                
-                # Update overall progress
-                job.percent = 45 + int((job.stats.tables_done / job.stats.tables_total) * 30)
-            
-            await send_progress(job_id, "log", level="info", msg="✓ Tüm veriler kopyalandı")
+            logger.info(f"WAL bytes ({'fast load' if job.fast_load else 'logged'}): {job.stats.wal_bytes}")
             
             # Stage 6: Constraints Apply
             job.stage = Stage.CONSTRAINTS_APPLY
             job.percent = 80
             await send_progress(job_id, "stage", v="constraints_apply")
-            await send_progress(job_id, "log", level="info", msg="Primary key'ler uygulanıyor...")
-            
-            await postgres_service.apply_primary_keys(pg_conn, schema_info, job.schema)
-            
-            await send_progress(job_id, "log", level="info", msg="Foreign key'ler uygulanıyor...")
-            await postgres_service.apply_foreign_keys(pg_conn, schema_info, job.schema)
-            
-            await send_progress(job_id, "log", level="info", msg="Index'ler uygulanıyor...")
-            await postgres_service.apply_indexes(pg_conn, schema_info, job.schema)
+            if not ckpt.reached('constraints_applied'):
+                async with scheduler.slot('constraints', job):
+                    # Constraints a resumed (or earlier) run already added are not added again
+                    existing = await postgres_service.get_constraint_names(pg_conn, job.schema)
+                    
+                    await send_progress(job_id, "log", level="info", msg="Primary key'ler uygulanıyor...")
+                    
+                    await _build_in_parallel(job, [
+                        (table, pk_sql)
+                        for table, pk_name, pk_sql in postgres_service.primary_key_statements(schema_info, job.schema)
+                        if pk_name not in existing
+                    ])
+                    
+                    await send_progress(job_id, "log", level="info", msg="Foreign key'ler uygulanıyor...")
+                    await _apply_foreign_keys(job, schema_info, artifacts_dir, existing)
+                    
+                    await send_progress(job_id, "log", level="info", msg="Index'ler uygulanıyor...")
+                    await _build_in_parallel(job, postgres_service.index_statements(schema_info, job.schema))
+                    await ckpt.mark_stage('constraints_applied')
             
             await send_progress(job_id, "log", level="info", msg="✓ Kısıtlamalar uygulandı")
             
@@ -210,6 +689,9 @@ async def run_migration(job_id: str):
             await send_progress(job_id, "stage", v="validate")
             await send_progress(job_id, "log", level="info", msg="Doğrulama yapılıyor...")
             
+            if exact_counts:
+                await exact_counts
+            
             # Validate row counts
             rowcount_data = []
             all_valid = True
@@ -220,6 +702,7 @@ async def run_migration(job_id: str):
                 )
                 
                 match = pg_count == table_info.row_count
+                table_info.error = None
                 if not match:
                     all_valid = False
                     table_info.error = f"Satır sayısı uyuşmuyor: MSSQL={table_info.row_count}, PG={pg_count}"
@@ -237,6 +720,14 @@ async def run_migration(job_id: str):
                 writer.writeheader()
                 writer.writerows(rowcount_data)
             
+            if job.validation_mode == "checksum":
+                await send_progress(job_id, "log", level="info", msg="Veri checksum'ları karşılaştırılıyor...")
+                validate_start = time.time()
+                async with scheduler.slot('copy', job):
+                    if not await _validate_checksums(job, schema_info, artifacts_dir):
+                        all_valid = False
+                job.stats.stage_durations['checksum_validation'] = time.time() - validate_start
+            
             if all_valid:
                 await send_progress(job_id, "log", level="info", msg="✓ Tüm tablolar doğrulandı")
             else:
@@ -247,6 +738,7 @@ async def run_migration(job_id: str):
             job.percent = 100
             job.status = JobStatus.DONE
             job.stats.elapsed_sec = time.time() - start_time
+            checkpoint.delete(job_id)
             
             await send_progress(job_id, "stage", v="done")
             await send_progress(job_id, "done", success=True)
@@ -260,21 +752,33 @@ async def run_migration(job_id: str):
         logger.error(f"Migration failed: {e}", exc_info=True)
         job.status = JobStatus.FAILED
         job.error = str(e)
+        # Finished stages and copied ranges are kept for POST /api/jobs/{id}/resume
+        await ckpt.save(force=True)
         
         # Save error log
-        artifacts_dir = Path(f"/app/artifacts/{job_id}")
         artifacts_dir.mkdir(parents=True, exist_ok=True)
         (artifacts_dir / "errors.log").write_text(f"Error: {e}\n")
         
         await send_progress(job_id, "error", msg=str(e))
         await send_progress(job_id, "log", level="error", msg=f"Hata: {e}")
+    
+    finally:
+        if exact_counts and not exact_counts.done():
+            exact_counts.cancel()
+        # Release the job's source database and pooled MSSQL connections
+        if lease:
+            # A failed job's own restored database stays for a resume
+            await restore_cache.release(lease, keep=job.status == JobStatus.FAILED and ckpt.reached('restored'))
+        await mssql_service.close_pool('master')
+        job.completed_at = datetime.now(timezone.utc)
+        job_store.mark_dirty(job)
 
 
 async def run_demo_migration(job_id: str):
     """
     Demo migration - simulates the process without real databases
     """
-    job = jobs.get(job_id)
+    job = await job_store.get(job_id)
     if not job:
         return
     
@@ -410,3 +914,7 @@ async def run_demo_migration(job_id: str):
         job.error = str(e)
         await send_progress(job_id, "error", msg=str(e))
         await send_progress(job_id, "log", level="error", msg=f"Hata: {e}")
+    
+    finally:
+        job.completed_at = datetime.now(timezone.utc)
+        job_store.mark_dirty(job)
@@ -1,33 +1,120 @@
 import pyodbc
+import asyncio
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator, Callable, Union
+from contextlib import contextmanager
 from pathlib import Path
+import threading
 import os
 
+from utils.executor import MeteredExecutor
+
 logger = logging.getLogger(__name__)
 
 MSSQL_HOST = os.environ.get('MSSQL_HOST', 'localhost')
 MSSQL_PORT = os.environ.get('MSSQL_PORT', '1433')
 MSSQL_SA_PWD = os.environ.get('MSSQL_SA_PWD', 'YourStrong!Passw0rd')
 TEMP_DB = os.environ.get('TEMP_DB', 'TempFromBak')
+MSSQL_POOL_SIZE = int(os.environ.get('MSSQL_POOL_SIZE', '4'))
+MSSQL_EXECUTOR_WORKERS = int(os.environ.get('MSSQL_EXECUTOR_WORKERS', '16'))
+
+# Every blocking pyodbc call runs here, never on the event loop
+executor = MeteredExecutor('mssql', MSSQL_EXECUTOR_WORKERS)
+
+def get_executor_metrics() -> Dict[str, Any]:
+    """Queue depth and wait time of the MSSQL executor"""
+    return executor.metrics()
+
+def job_database_name(job_id: str) -> str:
+    """Name of a job's own restore target, so concurrent jobs do not share TEMP_DB"""
+    return f"{TEMP_DB}_{job_id.replace('-', '')}"
 
 def get_connection_string(database='master'):
     return f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={MSSQL_HOST},{MSSQL_PORT};DATABASE={database};UID=sa;PWD={MSSQL_SA_PWD};TrustServerCertificate=yes;"
 
+class ConnectionPool:
+    """
+    Small pool of autocommit connections to one database.
+    Up to max_idle connections are kept open between uses; extra
+    concurrent users get a fresh connection that is closed on release.
+    """
+    def __init__(self, database: str, max_idle: int = MSSQL_POOL_SIZE):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle: List[pyodbc.Connection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> pyodbc.Connection:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = pyodbc.connect(get_connection_string(self.database), autocommit=True)
+        return conn
+
+    def release(self, conn: pyodbc.Connection, discard: bool = False):
+        if not discard:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            # The connection may be mid-result or broken, do not hand it out again
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database: str = TEMP_DB) -> ConnectionPool:
+    """Get the shared connection pool for a database"""
+    with _pools_lock:
+        if database not in _pools:
+            _pools[database] = ConnectionPool(database)
+        return _pools[database]
+
+async def close_pool(database: str = TEMP_DB):
+    """Close idle pooled connections for a database, e.g. at job end"""
+    await executor.run(_close_pool, database)
+
+def _close_pool(database: str):
+    with _pools_lock:
+        pool = _pools.pop(database, None)
+    if pool:
+        pool.close()
+
 async def verify_backup(bak_path: str) -> bool:
     """
     Verify .bak file integrity using RESTORE VERIFYONLY
     """
+    return await executor.run(_verify_backup, bak_path)
+
+def _verify_backup(bak_path: str) -> bool:
     try:
-        conn = pyodbc.connect(get_connection_string(), autocommit=True)
-        cursor = conn.cursor()
-        
-        query = f"RESTORE VERIFYONLY FROM DISK = '{bak_path}'"
-        logger.info(f"Verifying backup: {query}")
-        cursor.execute(query)
-        
-        cursor.close()
-        conn.close()
+        with get_pool('master').connection() as conn:
+            cursor = conn.cursor()
+            
+            query = f"RESTORE VERIFYONLY FROM DISK = '{bak_path}'"
+            logger.info(f"Verifying backup: {query}")
+            cursor.execute(query)
+            
+            cursor.close()
         logger.info("Backup verification successful")
         return True
     except Exception as e:
@@ -38,69 +125,118 @@ async def get_backup_file_list(bak_path: str) -> List[Dict[str, str]]:
     """
     Get logical file names from backup using RESTORE FILELISTONLY
     """
+    return await executor.run(_get_backup_file_list, bak_path)
+
+def _get_backup_file_list(bak_path: str) -> List[Dict[str, str]]:
     try:
-        conn = pyodbc.connect(get_connection_string(), autocommit=True)
-        cursor = conn.cursor()
-        
-        query = f"RESTORE FILELISTONLY FROM DISK = '{bak_path}'"
-        cursor.execute(query)
-        
-        files = []
-        for row in cursor.fetchall():
-            files.append({
-                'logical_name': row.LogicalName,
-                'type': row.Type  # D = Data, L = Log
-            })
-        
-        cursor.close()
-        conn.close()
+        with get_pool('master').connection() as conn:
+            cursor = conn.cursor()
+            
+            query = f"RESTORE FILELISTONLY FROM DISK = '{bak_path}'"
+            cursor.execute(query)
+            
+            files = []
+            for row in cursor.fetchall():
+                files.append({
+                    'logical_name': row.LogicalName,
+                    'type': row.Type,  # D = Data, L = Log
+                    'size': int(row.Size)  # bytes once restored
+                })
+            
+            cursor.close()
         return files
     except Exception as e:
         logger.error(f"Failed to get file list: {e}")
         raise
 
-async def restore_database(bak_path: str, logical_files: List[Dict[str, str]]) -> bool:
+async def restore_database(bak_path: str, logical_files: List[Dict[str, str]], database: str = TEMP_DB) -> bool:
     """
-    Restore database to TEMP_DB
+    Restore database (TEMP_DB by default), replacing it if it exists.
+    How many run at once is up to the scheduler's restore slots
     """
+    return await executor.run(_restore_database, bak_path, logical_files, database)
+
+def _drop_database(cursor: pyodbc.Cursor, database: str):
+    cursor.execute(f"IF DB_ID(?) IS NOT NULL ALTER DATABASE [{database}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE", database)
+    cursor.execute(f"IF DB_ID(?) IS NOT NULL DROP DATABASE [{database}]", database)
+
+def _restore_database(bak_path: str, logical_files: List[Dict[str, str]], database: str) -> bool:
     try:
-        conn = pyodbc.connect(get_connection_string(), autocommit=True)
-        cursor = conn.cursor()
-        
-        # Drop if exists
-        try:
-            cursor.execute(f"ALTER DATABASE [{TEMP_DB}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE")
-            cursor.execute(f"DROP DATABASE [{TEMP_DB}]")
-        except:
-            pass
-        
-        # Build RESTORE command with MOVE clauses
-        move_clauses = []
-        for lf in logical_files:
-            if lf['type'] == 'D':
-                move_clauses.append(f"MOVE '{lf['logical_name']}' TO '/var/opt/mssql/data/{TEMP_DB}.mdf'")
-            elif lf['type'] == 'L':
-                move_clauses.append(f"MOVE '{lf['logical_name']}' TO '/var/opt/mssql/data/{TEMP_DB}.ldf'")
-        
-        restore_query = f"""
-        RESTORE DATABASE [{TEMP_DB}]
-        FROM DISK = '{bak_path}'
-        WITH {', '.join(move_clauses)},
-        RECOVERY, REPLACE
-        """
-        
-        logger.info(f"Restoring database: {restore_query}")
-        cursor.execute(restore_query)
+        # Pooled connections to the old database would be killed by the drop
+        _close_pool(database)
         
-        cursor.close()
-        conn.close()
-        logger.info(f"Database restored to {TEMP_DB}")
+        with get_pool('master').connection() as conn:
+            cursor = conn.cursor()
+            
+            # Drop if exists
+            try:
+                _drop_database(cursor, database)
+            except Exception as e:
+                logger.warning(f"Could not drop {database} before restore: {e}")
+            
+            # Build RESTORE command with MOVE clauses, file names follow the database name
+            move_clauses = []
+            data_files = 0
+            for lf in logical_files:
+                if lf['type'] == 'D':
+                    suffix = f"_{data_files}.ndf" if data_files else ".mdf"
+                    data_files += 1
+                    move_clauses.append(f"MOVE '{lf['logical_name']}' TO '/var/opt/mssql/data/{database}{suffix}'")
+                elif lf['type'] == 'L':
+                    move_clauses.append(f"MOVE '{lf['logical_name']}' TO '/var/opt/mssql/data/{database}.ldf'")
+            
+            restore_query = f"""
+            RESTORE DATABASE [{database}]
+            FROM DISK = '{bak_path}'
+            WITH {', '.join(move_clauses)},
+            RECOVERY, REPLACE
+            """
+            
+            logger.info(f"Restoring database: {restore_query}")
+            cursor.execute(restore_query)
+            
+            # RESTORE reports progress as extra result sets, drain them
+            while cursor.nextset():
+                pass
+            
+            cursor.close()
+        logger.info(f"Database restored to {database}")
         return True
     except Exception as e:
         logger.error(f"Database restore failed: {e}")
         raise
 
-async def discover_schema() -> Dict[str, Any]:
+async def drop_database(database: str):
+    """Drop a database if it exists"""
+    await executor.run(_drop_database_now, database)
+
+def _drop_database_now(database: str):
+    _close_pool(database)
+    with get_pool('master').connection() as conn:
+        cursor = conn.cursor()
+        _drop_database(cursor, database)
+        cursor.close()
+    logger.info(f"Dropped database {database}")
+
+async def get_database_sizes(prefix: str) -> Dict[str, int]:
+    """Allocated file size in bytes of every online database whose name starts with prefix"""
+    return await executor.run(_get_database_sizes, prefix)
+
+def _get_database_sizes(prefix: str) -> Dict[str, int]:
+    with get_pool('master').connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT d.name, SUM(CAST(mf.size AS BIGINT)) * 8192 AS size_bytes
+        FROM sys.databases d
+        INNER JOIN sys.master_files mf ON d.database_id = mf.database_id
+        WHERE d.name LIKE ? AND d.state_desc = 'ONLINE'
+        GROUP BY d.name
+        """, prefix.replace('_', '[_]') + '%')
+        sizes = {row.name: int(row.size_bytes) for row in cursor.fetchall()}
+        cursor.close()
+    return sizes
+
+async def discover_schema(database: str = TEMP_DB) -> Dict[str, Any]:
     """
     Discover schema from restored database
     Returns: {
@@ -114,37 +250,43 @@ async def discover_schema() -> Dict[str, Any]:
         }]
     }
     """
+    return await executor.run(_discover_schema, database)
+
+def _discover_schema(database: str) -> Dict[str, Any]:
+    # One catalog query per object kind for the whole database, grouped by
+    # object_id here, instead of four round trips per table
     try:
-        conn = pyodbc.connect(get_connection_string(TEMP_DB))
-        cursor = conn.cursor()
-        
-        schema_info = {'tables': []}
-        
-        # Get all user tables
-        cursor.execute("""
-        SELECT s.name as schema_name, t.name as table_name, t.object_id
-        FROM sys.tables t
-        INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
-        WHERE t.is_ms_shipped = 0
-        ORDER BY s.name, t.name
-        """)
-        
-        tables = cursor.fetchall()
-        
-        for table in tables:
-            schema_name, table_name, object_id = table
-            table_info = {
-                'schema': schema_name,
-                'name': table_name,
-                'columns': [],
-                'primary_key': None,
-                'foreign_keys': [],
-                'indexes': []
-            }
+        with get_pool(database).connection() as conn:
+            cursor = conn.cursor()
+            
+            schema_info = {'tables': []}
+            
+            # Get all user tables
+            cursor.execute("""
+            SELECT s.name as schema_name, t.name as table_name, t.object_id
+            FROM sys.tables t
+            INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
+            WHERE t.is_ms_shipped = 0
+            ORDER BY s.name, t.name
+            """)
+            
+            tables = {}
+            for schema_name, table_name, object_id in cursor.fetchall():
+                table_info = {
+                    'schema': schema_name,
+                    'name': table_name,
+                    'columns': [],
+                    'primary_key': None,
+                    'foreign_keys': [],
+                    'indexes': []
+                }
+                tables[object_id] = table_info
+                schema_info['tables'].append(table_info)
             
             # Get columns
-            cursor.execute(f"""
+            cursor.execute("""
             SELECT 
+                c.object_id,
                 c.name,
                 t.name as type_name,
                 c.max_length,
@@ -154,12 +296,15 @@ async def discover_schema() -> Dict[str, Any]:
                 c.is_identity
             FROM sys.columns c
             INNER JOIN sys.types t ON c.user_type_id = t.user_type_id
-            WHERE c.object_id = ?
-            ORDER BY c.column_id
-            """, object_id)
+            INNER JOIN sys.tables tb ON c.object_id = tb.object_id
+            WHERE tb.is_ms_shipped = 0
+            ORDER BY c.object_id, c.column_id
+            """)
             
             for col in cursor.fetchall():
-                table_info['columns'].append({
+                if col.object_id not in tables:
+                    continue
+                tables[col.object_id]['columns'].append({
                     'name': col.name,
                     'type': col.type_name,
                     'max_length': col.max_length,
@@ -169,23 +314,32 @@ async def discover_schema() -> Dict[str, Any]:
                     'is_identity': col.is_identity
                 })
             
-            # Get primary key
-            cursor.execute(f"""
-            SELECT kc.name as column_name
+            # Get primary keys
+            cursor.execute("""
+            SELECT k.parent_object_id as object_id, kc.name as column_name, i.type as index_type
             FROM sys.key_constraints k
+            INNER JOIN sys.indexes i ON k.parent_object_id = i.object_id AND k.unique_index_id = i.index_id
             INNER JOIN sys.index_columns ic ON k.parent_object_id = ic.object_id AND k.unique_index_id = ic.index_id
             INNER JOIN sys.columns kc ON ic.object_id = kc.object_id AND ic.column_id = kc.column_id
-            WHERE k.parent_object_id = ? AND k.type = 'PK'
-            ORDER BY ic.key_ordinal
-            """, object_id)
+            WHERE k.type = 'PK'
+            ORDER BY k.parent_object_id, ic.key_ordinal
+            """)
             
-            pk_cols = [row.column_name for row in cursor.fetchall()]
-            if pk_cols:
-                table_info['primary_key'] = {'columns': pk_cols}
+            for row in cursor.fetchall():
+                table_info = tables.get(row.object_id)
+                if table_info is None:
+                    continue
+                if table_info['primary_key'] is None:
+                    table_info['primary_key'] = {
+                        'columns': [],
+                        'is_clustered': row.index_type == 1
+                    }
+                table_info['primary_key']['columns'].append(row.column_name)
             
             # Get foreign keys
-            cursor.execute(f"""
+            cursor.execute("""
             SELECT 
+                fk.parent_object_id as object_id,
                 fk.name as fk_name,
                 c.name as column_name,
                 rs.name as ref_schema,
@@ -197,11 +351,13 @@ async def discover_schema() -> Dict[str, Any]:
             INNER JOIN sys.tables rt ON fkc.referenced_object_id = rt.object_id
             INNER JOIN sys.schemas rs ON rt.schema_id = rs.schema_id
             INNER JOIN sys.columns rc ON fkc.referenced_object_id = rc.object_id AND fkc.referenced_column_id = rc.column_id
-            WHERE fk.parent_object_id = ?
-            """, object_id)
+            ORDER BY fk.parent_object_id
+            """)
             
             for fk in cursor.fetchall():
-                table_info['foreign_keys'].append({
+                if fk.object_id not in tables:
+                    continue
+                tables[fk.object_id]['foreign_keys'].append({
                     'name': fk.fk_name,
                     'column': fk.column_name,
                     'ref_schema': fk.ref_schema,
@@ -210,34 +366,39 @@ async def discover_schema() -> Dict[str, Any]:
                 })
             
             # Get indexes
-            cursor.execute(f"""
+            cursor.execute("""
             SELECT 
+                i.object_id,
                 i.name as index_name,
                 i.is_unique,
+                i.type as index_type,
                 c.name as column_name
             FROM sys.indexes i
             INNER JOIN sys.index_columns ic ON i.object_id = ic.object_id AND i.index_id = ic.index_id
             INNER JOIN sys.columns c ON ic.object_id = c.object_id AND ic.column_id = c.column_id
-            WHERE i.object_id = ? AND i.is_primary_key = 0 AND i.type > 0
-            ORDER BY i.name, ic.key_ordinal
-            """, object_id)
+            INNER JOIN sys.tables tb ON i.object_id = tb.object_id
+            WHERE tb.is_ms_shipped = 0 AND i.is_primary_key = 0 AND i.type > 0
+            ORDER BY i.object_id, i.name, ic.key_ordinal
+            """)
             
-            idx_dict = {}
+            idx_dicts: Dict[int, Dict[str, Dict[str, Any]]] = {}
             for idx in cursor.fetchall():
+                if idx.object_id not in tables:
+                    continue
+                idx_dict = idx_dicts.setdefault(idx.object_id, {})
                 if idx.index_name not in idx_dict:
                     idx_dict[idx.index_name] = {
                         'name': idx.index_name,
                         'is_unique': idx.is_unique,
+                        'is_clustered': idx.index_type == 1,
                         'columns': []
                     }
                 idx_dict[idx.index_name]['columns'].append(idx.column_name)
             
-            table_info['indexes'] = list(idx_dict.values())
+            for object_id, idx_dict in idx_dicts.items():
+                tables[object_id]['indexes'] = list(idx_dict.values())
             
-            schema_info['tables'].append(table_info)
-        
-        cursor.close()
-        conn.close()
+            cursor.close()
         
         logger.info(f"Discovered {len(schema_info['tables'])} tables")
         return schema_info
@@ -245,39 +406,295 @@ async def discover_schema() -> Dict[str, Any]:
         logger.error(f"Schema discovery failed: {e}")
         raise
 
-async def get_table_row_count(schema: str, table: str) -> int:
+async def get_table_sizes(database: str = TEMP_DB) -> Dict[Tuple[str, str], Dict[str, int]]:
     """
-    Get row count for a table
+    Row count and size of every user table in one query from sys.dm_db_partition_stats
+    Returns {(schema, table): {'rows', 'data_bytes', 'reserved_bytes'}}
+    rows and data_bytes cover the heap or clustered index, reserved_bytes all indexes.
+    Counts are metadata and can be slightly off; use get_table_row_count for an exact count
     """
+    return await executor.run(_get_table_sizes, database)
+
+def _get_table_sizes(database: str) -> Dict[Tuple[str, str], Dict[str, int]]:
     try:
-        conn = pyodbc.connect(get_connection_string(TEMP_DB))
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT COUNT(*) FROM [{schema}].[{table}]")
-        count = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+        with get_pool(database).connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+            SELECT
+                s.name as schema_name,
+                t.name as table_name,
+                SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.row_count ELSE 0 END) as row_count,
+                SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.used_page_count ELSE 0 END) * 8192 as data_bytes,
+                SUM(ps.reserved_page_count) * 8192 as reserved_bytes
+            FROM sys.dm_db_partition_stats ps
+            INNER JOIN sys.tables t ON ps.object_id = t.object_id
+            INNER JOIN sys.schemas s ON t.schema_id = s.schema_id
+            WHERE t.is_ms_shipped = 0
+            GROUP BY s.name, t.name
+            """)
+            sizes = {
+                (row.schema_name, row.table_name): {
+                    'rows': int(row.row_count),
+                    'data_bytes': int(row.data_bytes),
+                    'reserved_bytes': int(row.reserved_bytes)
+                }
+                for row in cursor.fetchall()
+            }
+            cursor.close()
+        return sizes
+    except Exception as e:
+        logger.error(f"Failed to get table sizes: {e}")
+        raise
+
+async def get_table_row_count(schema: str, table: str, database: str = TEMP_DB) -> Optional[int]:
+    """
+    Exact row count for a table (full COUNT_BIG scan), None if it fails
+    """
+    return await executor.run(_get_table_row_count, schema, table, database)
+
+def _get_table_row_count(schema: str, table: str, database: str) -> Optional[int]:
+    try:
+        with get_pool(database).connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT_BIG(*) FROM [{schema}].[{table}]")
+            count = cursor.fetchone()[0]
+            cursor.close()
         return count
     except Exception as e:
         logger.error(f"Failed to get row count: {e}")
-        return 0
+        return None
 
-async def fetch_table_data_batch(schema: str, table: str, columns: List[str], offset: int, limit: int) -> List[tuple]:
+def get_seek_columns(table_meta: Dict[str, Any]) -> Optional[List[str]]:
     """
-    Fetch data batch from MSSQL table
+    Pick the columns used for keyset reads: a clustered primary key, otherwise a
+    unique clustered index on NOT NULL columns. Reading in clustered key order
+    needs no sort, so the stream can be ordered and split into ranges by key.
+    Returns None for heaps and tables clustered on a non-unique key.
     """
-    try:
-        conn = pyodbc.connect(get_connection_string(TEMP_DB))
+    pk = table_meta.get('primary_key')
+    if pk and pk.get('is_clustered', True):
+        return pk['columns']
+    
+    nullable = {c['name'] for c in table_meta['columns'] if c['is_nullable']}
+    for idx in table_meta.get('indexes', []):
+        if idx.get('is_clustered') and idx['is_unique'] and not nullable.intersection(idx['columns']):
+            return idx['columns']
+    return None
+
+def build_range_predicate(key_column: str, key_range: Tuple[Any, Any]) -> Tuple[str, List[Any]]:
+    """
+    Build "lo < k <= hi" on the leading key column, None leaves that side open.
+    Returns (sql, params)
+    """
+    lo, hi = key_range
+    parts = []
+    params = []
+    if lo is not None:
+        parts.append(f"[{key_column}] > ?")
+        params.append(lo)
+    if hi is not None:
+        parts.append(f"[{key_column}] <= ?")
+        params.append(hi)
+    return ' AND '.join(parts), params
+
+def _column_type_decl(col: Dict[str, Any]) -> str:
+    """T-SQL type declaration for a discovered column, used to CAST sql_variant values"""
+    type_name = col['type'].lower()
+    if type_name in ('varchar', 'char', 'varbinary', 'binary'):
+        return f"{type_name}({'max' if col['max_length'] == -1 else col['max_length']})"
+    if type_name in ('nvarchar', 'nchar'):
+        return f"{type_name}({'max' if col['max_length'] == -1 else col['max_length'] // 2})"
+    if type_name in ('decimal', 'numeric'):
+        return f"{type_name}({col['precision']},{col['scale']})"
+    if type_name in ('datetime2', 'datetimeoffset', 'time'):
+        return f"{type_name}({col['scale']})"
+    return type_name
+
+def _pick_bounds(steps: List[Tuple[Any, int]], partitions: int) -> List[Any]:
+    """Choose partitions - 1 upper bounds from (key, rows up to and including key) steps"""
+    total = sum(rows for _, rows in steps)
+    if total <= 0:
+        return []
+    
+    bounds = []
+    cumulative = 0
+    target = total / partitions
+    for key, rows in steps:
+        cumulative += rows
+        if len(bounds) < partitions - 1 and cumulative >= target * (len(bounds) + 1):
+            if not bounds or key > bounds[-1]:
+                bounds.append(key)
+    return bounds
+
+async def get_key_range_bounds(table_meta: Dict[str, Any], partitions: int, row_count: int,
+                               database: str = TEMP_DB) -> List[Any]:
+    """
+    Split a table into about equal ranges on the leading seek key column.
+    Uses the clustered index histogram, falls back to NTILE over a TABLESAMPLE.
+    Returns ascending upper bounds, at most partitions - 1 of them
+    """
+    return await executor.run(_get_key_range_bounds, table_meta, partitions, row_count, database)
+
+def _get_key_range_bounds(table_meta: Dict[str, Any], partitions: int, row_count: int, database: str) -> List[Any]:
+    schema, table = table_meta['schema'], table_meta['name']
+    key_columns = get_seek_columns(table_meta)
+    if not key_columns or partitions < 2:
+        return []
+    
+    key_column = key_columns[0]
+    key_col = next(c for c in table_meta['columns'] if c['name'] == key_column)
+    type_decl = _column_type_decl(key_col)
+    
+    with get_pool(database).connection() as conn:
         cursor = conn.cursor()
+        try:
+            # Seek keys are clustered, so the clustered index (stats_id 1) leads with key_column
+            cursor.execute(f"""
+            SELECT CAST(h.range_high_key AS {type_decl}) AS range_high_key,
+                   h.equal_rows + h.range_rows AS step_rows
+            FROM sys.dm_db_stats_histogram(OBJECT_ID(?), 1) h
+            ORDER BY h.step_number
+            """, f"[{schema}].[{table}]")
+            steps = [(row.range_high_key, int(row.step_rows)) for row in cursor.fetchall()]
+            bounds = _pick_bounds(steps, partitions)
+            if bounds:
+                return bounds
+        except Exception as e:
+            logger.info(f"No histogram for {schema}.{table}, sampling instead: {e}")
         
-        col_names = ', '.join([f'[{c}]' for c in columns])
-        query = f"SELECT {col_names} FROM [{schema}].[{table}] ORDER BY (SELECT NULL) OFFSET {offset} ROWS FETCH NEXT {limit} ROWS ONLY"
-        
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        
+        # Sample about 1000 keys per partition
+        sample_percent = min(100.0, max(0.01, partitions * 1000 * 100.0 / max(row_count, 1)))
+        cursor.execute(f"""
+        SELECT MAX([{key_column}]) AS range_high_key, COUNT(*) AS step_rows
+        FROM (
+            SELECT [{key_column}], NTILE(?) OVER (ORDER BY [{key_column}]) AS bucket
+            FROM [{schema}].[{table}] TABLESAMPLE ({sample_percent:.4f} PERCENT)
+        ) sampled
+        GROUP BY bucket
+        ORDER BY bucket
+        """, partitions)
+        steps = [(row.range_high_key, int(row.step_rows)) for row in cursor.fetchall()]
         cursor.close()
-        conn.close()
-        return rows
+    
+    return _pick_bounds(steps, partitions)
+
+async def get_range_split_key(table_meta: Dict[str, Any], key_range: Optional[Tuple[Any, Any]], rows: int,
+                              database: str = TEMP_DB) -> Any:
+    """
+    Leading key value of the rows-th row of key_range in key order, so that (lo, key]
+    holds about rows rows. None if the range has fewer rows or no seek key
+    """
+    return await executor.run(_get_range_split_key, table_meta, key_range, rows, database)
+
+def _get_range_split_key(table_meta: Dict[str, Any], key_range: Optional[Tuple[Any, Any]], rows: int, database: str) -> Any:
+    schema, table = table_meta['schema'], table_meta['name']
+    key_columns = get_seek_columns(table_meta)
+    if not key_columns or rows < 1:
+        return None
+    
+    key_column = key_columns[0]
+    query = f"SELECT [{key_column}] FROM [{schema}].[{table}]"
+    params = []
+    if key_range is not None and key_range != (None, None):
+        predicate, params = build_range_predicate(key_column, key_range)
+        query += " WHERE " + predicate
+    # Walks the clustered index from lo, reading about rows keys
+    query += f" ORDER BY [{key_column}] OFFSET ? ROWS FETCH NEXT 1 ROWS ONLY"
+    
+    with get_pool(database).connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, *params, rows - 1)
+        row = cursor.fetchone()
+        cursor.close()
+    return row[0] if row else None
+
+def bounds_to_ranges(bounds: List[Any]) -> List[Tuple[Any, Any]]:
+    """Turn ascending upper bounds into (lo, hi] ranges covering the whole key space"""
+    edges = [None] + list(bounds) + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+async def stream_table_data(schema: str, table: str, columns: List[str], batch_size: Union[int, Callable[[], int]],
+                            key_columns: Optional[List[str]] = None,
+                            key_range: Optional[Tuple[Any, Any]] = None,
+                            database: str = TEMP_DB) -> AsyncIterator[List[tuple]]:
+    """
+    Stream a table through one pooled connection and one forward-only cursor.
+    With key_columns the rows come in key order, limited to key_range on the
+    leading key column.
+    batch_size may be a callable, asked for the row count before every fetch.
+    """
+    next_size = batch_size if callable(batch_size) else (lambda: batch_size)
+    col_names = ', '.join([f'[{c}]' for c in columns])
+    query = f"SELECT {col_names} FROM [{schema}].[{table}]"
+    params = []
+    if key_columns:
+        if key_range is not None and key_range != (None, None):
+            predicate, params = build_range_predicate(key_columns[0], key_range)
+            query += " WHERE " + predicate
+        query += " ORDER BY " + ', '.join([f'[{c}]' for c in key_columns])
+    
+    pool = get_pool(database)
+    conn = await executor.run(pool.acquire)
+    cursor = conn.cursor()
+    exhausted = False
+    failed = False
+    in_flight: Optional[asyncio.Future] = None
+    
+    async def call(fn, *args):
+        nonlocal in_flight
+        # Shielded: cancelling the stream must not leave the call running while the cursor is closed
+        in_flight = asyncio.ensure_future(executor.run(fn, *args))
+        return await asyncio.shield(in_flight)
+    
+    try:
+        await call(cursor.execute, query, *params)
+        while rows := await call(cursor.fetchmany, next_size()):
+            yield rows
+        exhausted = True
     except Exception as e:
-        logger.error(f"Failed to fetch data batch: {e}")
+        failed = True
+        logger.error(f"Failed to stream table data: {e}")
         raise
+    finally:
+        if in_flight is not None and not in_flight.done():
+            # Cancelled mid-call: cancel the statement, then wait for the call to return
+            await executor.run(_cancel_cursor, cursor)
+            await asyncio.wait([in_flight])
+            failed = True
+        await executor.run(_finish_stream, pool, conn, cursor, exhausted, failed)
+
+def _cancel_cursor(cursor: pyodbc.Cursor):
+    try:
+        cursor.cancel()
+    except Exception as e:
+        logger.warning(f"Failed to cancel stream cursor: {e}")
+
+def _finish_stream(pool: ConnectionPool, conn: pyodbc.Connection, cursor: pyodbc.Cursor, exhausted: bool, failed: bool):
+    """Close a streaming cursor and hand its connection back to the pool"""
+    try:
+        if not exhausted:
+            # Stop the server from sending the rest of the result set
+            cursor.cancel()
+        cursor.close()
+    except Exception as e:
+        logger.warning(f"Failed to close stream cursor: {e}")
+        failed = True
+    pool.release(conn, discard=failed)
+
+async def iter_table_batches(table_meta: Dict[str, Any], batch_size: Union[int, Callable[[], int]],
+                             key_range: Optional[Tuple[Any, Any]] = None,
+                             database: str = TEMP_DB) -> AsyncIterator[List[tuple]]:
+    """
+    Yield row batches for a table (or one key_range of it) in a stable order.
+    Keyed tables are read in clustered key order, heaps in storage order.
+    """
+    schema, table = table_meta['schema'], table_meta['name']
+    columns = [col['name'] for col in table_meta['columns']]
+    key_columns = get_seek_columns(table_meta)
+    
+    if not key_columns:
+        logger.info(f"No seek key on {schema}.{table}, streaming in storage order")
+    
+    async for rows in stream_table_data(schema, table, columns, batch_size, key_columns,
+                                        key_range=key_range, database=database):
+        yield rows
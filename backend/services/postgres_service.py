@@ -1,12 +1,23 @@
 import psycopg
-from psycopg import sql
+from psycopg import pq, sql
+from psycopg.adapt import PyFormat, Transformer
 import logging
-from typing import List, Dict, Any
+import struct
+import time
+from typing import List, Dict, Any, Callable, Optional, Tuple, AsyncIterator
+from contextlib import asynccontextmanager
 from services.type_mapper import map_mssql_to_pg_type
-import io
+from utils.tasks import gather_or_cancel
 
 logger = logging.getLogger(__name__)
 
+# Binary COPY framing: signature, flags and header extension length, then the end marker
+COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + bytes(8)
+COPY_BINARY_TRAILER = b'\xff\xff'
+_BINARY_NULL = b'\xff\xff\xff\xff'
+_INT2 = struct.Struct('!h')
+_INT4 = struct.Struct('!i')
+
 async def get_pg_connection(pg_uri: str):
     """Get PostgreSQL connection"""
     return await psycopg.AsyncConnection.connect(pg_uri)
@@ -19,93 +30,108 @@ async def create_schema(conn, schema_name: str):
         ))
         await conn.commit()
 
-async def generate_and_apply_ddl(conn, schema_info: Dict[str, Any], target_schema: str) -> str:
+def generate_ddl(schema_info: Dict[str, Any], target_schema: str, unlogged: bool = False) -> List[str]:
     """
-    Generate and apply DDL for all tables (without constraints)
-    Returns DDL SQL string
+    CREATE TABLE statements for all tables (without constraints)
+    unlogged=True creates UNLOGGED tables for fast loading (see set_table_logged)
     """
+    table_kind = "UNLOGGED TABLE" if unlogged else "TABLE"
     ddl_statements = []
     
-    async with conn.cursor() as cursor:
-        for table in schema_info['tables']:
-            table_name = table['name'].lower()
+    for table in schema_info['tables']:
+        table_name = table['name'].lower()
+        
+        # Build column definitions
+        col_defs = []
+        for col in table['columns']:
+            col_name = col['name'].lower()
+            pg_type = map_mssql_to_pg_type(
+                col['type'],
+                col['max_length'],
+                col['precision'],
+                col['scale']
+            )
             
-            # Build column definitions
-            col_defs = []
-            for col in table['columns']:
-                col_name = col['name'].lower()
-                pg_type = map_mssql_to_pg_type(
-                    col['type'],
-                    col['max_length'],
-                    col['precision'],
-                    col['scale']
-                )
-                
-                null_clause = "" if col['is_nullable'] else "NOT NULL"
-                
-                # Handle IDENTITY columns
-                if col['is_identity']:
-                    if 'INT' in pg_type.upper():
-                        pg_type = pg_type.replace('INTEGER', 'INTEGER GENERATED BY DEFAULT AS IDENTITY')
-                        pg_type = pg_type.replace('BIGINT', 'BIGINT GENERATED BY DEFAULT AS IDENTITY')
-                
-                col_defs.append(f"{col_name} {pg_type} {null_clause}".strip())
+            null_clause = "" if col['is_nullable'] else "NOT NULL"
             
-            # Create table
-            create_table = f"""
-            CREATE TABLE IF NOT EXISTS {target_schema}.{table_name} (
+            # Handle IDENTITY columns
+            if col['is_identity']:
+                if 'INT' in pg_type.upper():
+                    pg_type = pg_type.replace('INTEGER', 'INTEGER GENERATED BY DEFAULT AS IDENTITY')
+                    pg_type = pg_type.replace('BIGINT', 'BIGINT GENERATED BY DEFAULT AS IDENTITY')
+            
+            col_defs.append(f"{col_name} {pg_type} {null_clause}".strip())
+        
+        # Create table
+        create_table = f"""
+            CREATE {table_kind} IF NOT EXISTS {target_schema}.{table_name} (
                 {', '.join(col_defs)}
             )
             """
-            
-            ddl_statements.append(create_table)
-            await cursor.execute(create_table)
-            logger.info(f"Created table: {target_schema}.{table_name}")
         
+        ddl_statements.append(create_table)
+    
+    return ddl_statements
+
+async def apply_ddl(conn, ddl_statements: List[str]) -> str:
+    """
+    Apply DDL statements in one transaction
+    Returns DDL SQL string
+    """
+    async with conn.cursor() as cursor:
+        for statement in ddl_statements:
+            await cursor.execute(statement)
         await conn.commit()
+    logger.info(f"Applied {len(ddl_statements)} DDL statements")
     
     return "\n\n".join(ddl_statements)
 
-async def copy_data_to_table(conn, schema_name: str, table_name: str, columns: List[str], rows: List[tuple]):
+def binary_row_dumper(conn, binary_types: List[str]) -> Callable[[tuple, bytearray], None]:
     """
-    Copy data using COPY FROM STDIN for performance
+    Function appending one row in binary COPY format to a buffer, for columns of
+    binary_types. Built with the connection's adapters, then safe to call in a worker thread
     """
-    if not rows:
-        return
+    transformer = Transformer(conn)
+    registry = conn.adapters.types
+    transformer.set_dumper_types([registry.get_oid(t) for t in binary_types], pq.Format.BINARY)
+    formats = [PyFormat.BINARY] * len(binary_types)
+    field_count = _INT2.pack(len(binary_types))
     
+    def dump_row(row: tuple, out: bytearray):
+        out += field_count
+        for value in transformer.dump_sequence(row, formats):
+            if value is None:
+                out += _BINARY_NULL
+            else:
+                out += _INT4.pack(len(value))
+                out += value
+    
+    return dump_row
+
+@asynccontextmanager
+async def open_copy(conn, schema_name: str, table_name: str, columns: List[str],
+                    binary: bool = False, commit: bool = True):
+    """
+    Open a COPY FROM STDIN stream and commit when the block exits, unless commit=False.
+    binary=True expects rows already encoded by a binary_row_dumper; the header and
+    end marker are written here
+    """
     table_name = table_name.lower()
     col_names = [c.lower() for c in columns]
+    options = " (FORMAT BINARY)" if binary else ""
     
     async with conn.cursor() as cursor:
-        # Create CSV-like data in memory
-        data_io = io.StringIO()
-        for row in rows:
-            # Convert values to strings, handle None
-            str_row = []
-            for val in row:
-                if val is None:
-                    str_row.append('\\N')
-                elif isinstance(val, bytes):
-                    # Convert bytes to hex for BYTEA
-                    str_row.append('\\\\x' + val.hex())
-                elif isinstance(val, bool):
-                    str_row.append('t' if val else 'f')
-                else:
-                    # Escape special characters
-                    str_val = str(val).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
-                    str_row.append(str_val)
-            
-            data_io.write('\t'.join(str_row) + '\n')
-        
-        data_io.seek(0)
-        
-        # Use COPY FROM STDIN
         async with cursor.copy(
-            f"COPY {schema_name}.{table_name} ({', '.join(col_names)}) FROM STDIN"
+            f"COPY {schema_name}.{table_name} ({', '.join(col_names)}) FROM STDIN{options}"
         ) as copy:
-            await copy.write(data_io.read())
+            if binary:
+                await copy.write(COPY_BINARY_HEADER)
+            yield copy
+            if binary:
+                await copy.write(COPY_BINARY_TRAILER)
         
-        await conn.commit()
+        if commit:
+            await conn.commit()
 
 async def truncate_table(conn, schema_name: str, table_name: str):
     """Truncate table with RESTART IDENTITY"""
@@ -116,101 +142,227 @@ async def truncate_table(conn, schema_name: str, table_name: str):
         ))
         await conn.commit()
 
-async def apply_primary_keys(conn, schema_info: Dict[str, Any], target_schema: str) -> List[str]:
+async def delete_key_range(conn, schema_name: str, table_name: str, key_column: str,
+                           key_range: Tuple[Any, Any]):
+    """Delete the rows of one key range, e.g. a range left half-copied by a failed job"""
+    predicate, params = _key_range_predicate(key_column, key_range)
+    async with conn.cursor() as cursor:
+        await cursor.execute(sql.SQL("DELETE FROM {} WHERE {}").format(
+            sql.Identifier(schema_name, table_name.lower()), predicate
+        ), params)
+        await conn.commit()
+
+async def table_has_rows(conn, schema_name: str, table_name: str) -> bool:
+    """True if the table is not empty"""
+    async with conn.cursor() as cursor:
+        await cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(
+            sql.Identifier(schema_name, table_name.lower())
+        ))
+        result = await cursor.fetchone()
+        await conn.commit()
+        return bool(result[0])
+
+async def set_table_logged(conn, schema_name: str, table_name: str, logged: bool):
+    """Switch a table between LOGGED and UNLOGGED"""
+    table_name = table_name.lower()
+    mode = sql.SQL("LOGGED" if logged else "UNLOGGED")
+    async with conn.cursor() as cursor:
+        await cursor.execute(sql.SQL("ALTER TABLE {} SET {}").format(
+            sql.Identifier(schema_name, table_name), mode
+        ))
+        await conn.commit()
+
+async def get_wal_lsn(conn) -> Optional[str]:
+    """Current WAL insert position, None if it cannot be read (e.g. on a standby)"""
+    try:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT pg_current_wal_lsn()::text")
+            result = await cursor.fetchone()
+            await conn.commit()
+            return result[0] if result else None
+    except Exception as e:
+        logger.warning(f"Failed to read WAL position: {e}")
+        await conn.rollback()
+        return None
+
+async def get_wal_bytes_since(conn, start_lsn: Optional[str]) -> Optional[int]:
     """
-    Apply primary key constraints
-    Returns list of SQL statements
+    WAL bytes written cluster-wide since start_lsn
+    (includes other sessions' activity, so it is an upper bound for the job)
     """
-    pk_statements = []
-    
+    if not start_lsn:
+        return None
+    end_lsn = await get_wal_lsn(conn)
+    if not end_lsn:
+        return None
     async with conn.cursor() as cursor:
-        for table in schema_info['tables']:
-            if not table.get('primary_key'):
-                continue
-            
-            table_name = table['name'].lower()
-            pk_cols = [c.lower() for c in table['primary_key']['columns']]
-            
-            pk_name = f"pk_{table_name}"
-            pk_sql = f"ALTER TABLE {target_schema}.{table_name} ADD CONSTRAINT {pk_name} PRIMARY KEY ({', '.join(pk_cols)})"
+        await cursor.execute("SELECT pg_wal_lsn_diff(%s::pg_lsn, %s::pg_lsn)::bigint", (end_lsn, start_lsn))
+        result = await cursor.fetchone()
+        await conn.commit()
+        return int(result[0]) if result else None
+
+def primary_key_statements(schema_info: Dict[str, Any], target_schema: str) -> List[Tuple[str, str, str]]:
+    """(table name, constraint name, ALTER TABLE ... ADD PRIMARY KEY) for every table with a primary key"""
+    statements = []
+    for table in schema_info['tables']:
+        if not table.get('primary_key'):
+            continue
+        
+        table_name = table['name'].lower()
+        pk_cols = [c.lower() for c in table['primary_key']['columns']]
+        
+        pk_name = f"pk_{table_name}"
+        pk_sql = f"ALTER TABLE {target_schema}.{table_name} ADD CONSTRAINT {pk_name} PRIMARY KEY ({', '.join(pk_cols)})"
+        statements.append((table['name'], pk_name, pk_sql))
+    return statements
+
+def index_statements(schema_info: Dict[str, Any], target_schema: str) -> List[Tuple[str, str]]:
+    """(table name, CREATE INDEX) for every secondary index"""
+    statements = []
+    for table in schema_info['tables']:
+        table_name = table['name'].lower()
+        
+        for idx in table.get('indexes') or []:
+            idx_name = f"idx_{table_name}_{idx['name'].lower()}"
+            unique = "UNIQUE" if idx['is_unique'] else ""
+            cols = ', '.join([c.lower() for c in idx['columns']])
             
-            try:
-                await cursor.execute(pk_sql)
-                pk_statements.append(pk_sql)
-                logger.info(f"Applied PK on {target_schema}.{table_name}")
-            except Exception as e:
-                logger.warning(f"Failed to apply PK on {table_name}: {e}")
+            idx_sql = f"CREATE {unique} INDEX IF NOT EXISTS {idx_name} ON {target_schema}.{table_name} ({cols})"
+            statements.append((table['name'], idx_sql))
+    return statements
+
+def foreign_key_statements(schema_info: Dict[str, Any], target_schema: str,
+                           not_valid: bool = False) -> List[Tuple[str, str, str]]:
+    """
+    (table name, constraint name, ALTER TABLE ... ADD FOREIGN KEY) for every foreign key.
+    not_valid=True adds the constraint without scanning existing rows
+    """
+    statements = []
+    for table in schema_info['tables']:
+        table_name = table['name'].lower()
         
+        for fk in table.get('foreign_keys') or []:
+            fk_name = f"fk_{table_name}_{fk['column'].lower()}"
+            ref_table = fk['ref_table'].lower()
+            fk_sql = (
+                f"ALTER TABLE {target_schema}.{table_name} "
+                f"ADD CONSTRAINT {fk_name} "
+                f"FOREIGN KEY ({fk['column'].lower()}) "
+                f"REFERENCES {target_schema}.{ref_table}({fk['ref_column'].lower()})"
+            )
+            if not_valid:
+                fk_sql += " NOT VALID"
+            statements.append((table['name'], fk_name, fk_sql))
+    return statements
+
+async def get_constraint_names(conn, schema_name: str) -> set:
+    """Names of the constraints already defined on tables of a schema"""
+    async with conn.cursor() as cursor:
+        await cursor.execute("""
+            SELECT con.conname FROM pg_constraint con
+            JOIN pg_namespace n ON n.oid = con.connamespace
+            WHERE n.nspname = %s
+        """, (schema_name,))
+        names = {row[0] for row in await cursor.fetchall()}
         await conn.commit()
-    
-    return pk_statements
+        return names
+
+def validate_constraint_sql(target_schema: str, table_name: str, constraint_name: str) -> str:
+    """ALTER TABLE ... VALIDATE CONSTRAINT for a constraint added as NOT VALID"""
+    return f"ALTER TABLE {target_schema}.{table_name.lower()} VALIDATE CONSTRAINT {constraint_name}"
 
-async def apply_foreign_keys(conn, schema_info: Dict[str, Any], target_schema: str) -> List[str]:
+async def open_maintenance_connection(pg_uri: str, maintenance_work_mem_mb: int, parallel_workers: int):
     """
-    Apply foreign key constraints
-    Returns list of SQL statements
+    Autocommit connection for index and constraint builds, so every statement
+    commits (or fails) on its own
+    """
+    conn = await psycopg.AsyncConnection.connect(pg_uri, autocommit=True)
+    try:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql.SQL("SET maintenance_work_mem = {}").format(
+                sql.Literal(f"{maintenance_work_mem_mb}MB")
+            ))
+            await cursor.execute(sql.SQL("SET max_parallel_maintenance_workers = {}").format(
+                sql.Literal(parallel_workers)
+            ))
+    except Exception:
+        await conn.close()
+        raise
+    return conn
+
+async def run_statements_parallel(pg_uri: str, statements: List[Tuple[str, str]], workers: int,
+                                  maintenance_work_mem_mb: int, parallel_workers: int) -> List[Dict[str, Any]]:
     """
-    fk_statements = []
+    Run (table name, SQL) statements in the given order on up to `workers`
+    maintenance connections. A failed statement is logged and skipped.
+    Returns one result per statement: table, sql, duration_sec, error (None on success)
+    """
+    pending = list(statements)
+    results: List[Dict[str, Any]] = []
     
-    async with conn.cursor() as cursor:
-        for table in schema_info['tables']:
-            if not table.get('foreign_keys'):
-                continue
-            
-            table_name = table['name'].lower()
-            
-            for fk in table['foreign_keys']:
-                fk_name = f"fk_{table_name}_{fk['column'].lower()}"
-                ref_table = fk['ref_table'].lower()
-                fk_sql = f"""
-                ALTER TABLE {target_schema}.{table_name} 
-                ADD CONSTRAINT {fk_name} 
-                FOREIGN KEY ({fk['column'].lower()}) 
-                REFERENCES {target_schema}.{ref_table}({fk['ref_column'].lower()})
-                """
-                
-                try:
-                    await cursor.execute(fk_sql)
-                    fk_statements.append(fk_sql)
-                    logger.info(f"Applied FK: {fk_name}")
-                except Exception as e:
-                    logger.warning(f"Failed to apply FK {fk_name}: {e}")
-        
-        await conn.commit()
+    async def worker():
+        conn = await open_maintenance_connection(pg_uri, maintenance_work_mem_mb, parallel_workers)
+        try:
+            async with conn.cursor() as cursor:
+                while pending:
+                    table_name, stmt = pending.pop(0)
+                    started = time.monotonic()
+                    error = None
+                    try:
+                        await cursor.execute(stmt)
+                    except psycopg.Error as e:
+                        error = str(e)
+                    duration = time.monotonic() - started
+                    results.append({'table': table_name, 'sql': stmt, 'duration_sec': duration, 'error': error})
+                    if error:
+                        logger.warning(f"Failed on {table_name}: {stmt}: {error}")
+                    else:
+                        logger.info(f"Ran on {table_name} in {duration:.1f}s: {stmt}")
+        finally:
+            await conn.close()
     
-    return fk_statements
+    count = max(1, min(workers, len(pending)))
+    if pending:
+        await gather_or_cancel(*[worker() for _ in range(count)])
+    return results
+
+def _key_range_predicate(key_column: str, key_range: Tuple[Any, Any]) -> Tuple[sql.Composable, List[Any]]:
+    """lo < key_column <= hi, None bounds are open (same ranges as mssql_service.build_range_predicate)"""
+    lo, hi = key_range
+    predicates = []
+    params = []
+    if lo is not None:
+        predicates.append(sql.SQL("{} > %s").format(sql.Identifier(key_column.lower())))
+        params.append(lo)
+    if hi is not None:
+        predicates.append(sql.SQL("{} <= %s").format(sql.Identifier(key_column.lower())))
+        params.append(hi)
+    return sql.SQL(' AND ').join(predicates or [sql.SQL("TRUE")]), params
 
-async def apply_indexes(conn, schema_info: Dict[str, Any], target_schema: str) -> List[str]:
+async def stream_table_rows(conn, schema_name: str, table_name: str, columns: List[str], batch_rows: int,
+                            key_column: Optional[str] = None,
+                            key_range: Optional[Tuple[Any, Any]] = None) -> AsyncIterator[List[tuple]]:
     """
-    Apply indexes
-    Returns list of SQL statements
+    Stream rows through a server-side cursor, limited to lo < key_column <= hi
+    when a key_range is given (None bounds are open)
     """
-    idx_statements = []
-    
-    async with conn.cursor() as cursor:
-        for table in schema_info['tables']:
-            if not table.get('indexes'):
-                continue
-            
-            table_name = table['name'].lower()
-            
-            for idx in table['indexes']:
-                idx_name = f"idx_{table_name}_{idx['name'].lower()}"
-                unique = "UNIQUE" if idx['is_unique'] else ""
-                cols = ', '.join([c.lower() for c in idx['columns']])
-                
-                idx_sql = f"CREATE {unique} INDEX IF NOT EXISTS {idx_name} ON {target_schema}.{table_name} ({cols})"
-                
-                try:
-                    await cursor.execute(idx_sql)
-                    idx_statements.append(idx_sql)
-                    logger.info(f"Applied index: {idx_name}")
-                except Exception as e:
-                    logger.warning(f"Failed to apply index {idx_name}: {e}")
-        
-        await conn.commit()
+    query = sql.SQL("SELECT {} FROM {}").format(
+        sql.SQL(', ').join([sql.Identifier(c.lower()) for c in columns]),
+        sql.Identifier(schema_name, table_name.lower())
+    )
+    params = []
+    if key_column and key_range:
+        predicate, params = _key_range_predicate(key_column, key_range)
+        query = sql.SQL("{} WHERE {}").format(query, predicate)
     
-    return idx_statements
+    try:
+        async with conn.cursor(name="pgr_stream") as cursor:
+            await cursor.execute(query, params)
+            while rows := await cursor.fetchmany(batch_rows):
+                yield rows
+    finally:
+        # Named cursors live in a transaction
+        await conn.rollback()
 
 async def get_table_row_count(conn, schema_name: str, table_name: str) -> int:
     """Get row count from PostgreSQL table"""
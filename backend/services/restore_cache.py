@@ -0,0 +1,174 @@
+"""
+Restored MSSQL databases kept warm between jobs, keyed by the SHA-256 of the .bak.
+A job for a backup that is already restored reads from that database instead of
+restoring again. Databases are named RESTORE_CACHE_PREFIX + hash and evicted
+least recently used first once their files exceed RESTORE_CACHE_MAX_GB;
+databases in use by a running job are never evicted.
+Last-use times are kept in a small JSON index next to the schema cache.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from services import mssql_service
+
+logger = logging.getLogger(__name__)
+
+RESTORE_CACHE_PREFIX = os.environ.get('RESTORE_CACHE_PREFIX', 'pgr_')
+# 0 disables the cache: every job restores into a temporary database of its own
+RESTORE_CACHE_MAX_BYTES = int(float(os.environ.get('RESTORE_CACHE_MAX_GB', '100')) * 1024 ** 3)
+INDEX_PATH = Path(os.environ.get(
+    'RESTORE_CACHE_INDEX', Path(__file__).parent.parent / "cache" / "restored_databases.json"
+))
+
+_index_lock = threading.Lock()
+_restore_locks: Dict[str, asyncio.Lock] = {}
+_refcounts: Dict[str, int] = {}
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+class Lease:
+    """
+    A job's hold on a source database; warm=True if no restore is needed.
+    Without a cache key (sha256=None) the database is the job's own and is dropped on release
+    """
+    def __init__(self, sha256: Optional[str], database: str):
+        self.sha256 = sha256
+        self.database = database
+        self.warm = False
+        self._lock: Optional[asyncio.Lock] = None
+
+def enabled() -> bool:
+    return RESTORE_CACHE_MAX_BYTES > 0
+
+def database_name(sha256: str) -> str:
+    return f"{RESTORE_CACHE_PREFIX}{sha256}"
+
+def _read_index() -> Dict[str, Dict[str, Any]]:
+    try:
+        return json.loads(INDEX_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable restore cache index: {e}")
+        return {}
+
+def _update_index(database: str, **fields):
+    """Merge fields into a database's index entry, or remove it if no fields are given"""
+    with _index_lock:
+        index = _read_index()
+        if fields:
+            index.setdefault(database, {}).update(fields)
+        else:
+            index.pop(database, None)
+        INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = INDEX_PATH.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, INDEX_PATH)
+
+async def acquire(sha256: Optional[str], temp_database: str, reuse_temp: bool = False) -> Lease:
+    """
+    Hold the cached database for a backup. If it is not restored yet the
+    per-backup restore lock stays held until ready() or release(), so concurrent
+    jobs for the same backup wait for one restore instead of racing.
+    With the cache disabled or no hash, the job restores into temp_database;
+    reuse_temp=True (resuming a failed job) uses it as is if it is still there.
+    """
+    if not enabled() or not sha256:
+        lease = Lease(None, temp_database)
+        if reuse_temp:
+            lease.warm = temp_database in await mssql_service.get_database_sizes(temp_database)
+        return lease
+
+    lease = Lease(sha256, database_name(sha256))
+    _refcounts[lease.database] = _refcounts.get(lease.database, 0) + 1
+    lock = _restore_locks.setdefault(lease.database, asyncio.Lock())
+    try:
+        await lock.acquire()
+        lease._lock = lock
+        sizes = await mssql_service.get_database_sizes(lease.database)
+    except BaseException:
+        _release_restore_lock(lease)
+        await _drop_ref(lease.database)
+        raise
+
+    if lease.database in sizes:
+        lease.warm = True
+        _stats['hits'] += 1
+        await ready(lease, sizes[lease.database])
+    else:
+        _stats['misses'] += 1
+    return lease
+
+async def make_room(lease: Lease, needed_bytes: int):
+    """Drop least recently used idle databases until needed_bytes more fits the quota"""
+    if not lease.sha256:
+        return
+    sizes = await mssql_service.get_database_sizes(RESTORE_CACHE_PREFIX)
+    index = await asyncio.to_thread(_read_index)
+    total = sum(sizes.values())
+    # Databases missing from the index (e.g. from an older run) go first
+    candidates = sorted(
+        (name for name in sizes if name != lease.database and not _refcounts.get(name)),
+        key=lambda name: index.get(name, {}).get('last_used', 0)
+    )
+    for name in candidates:
+        if total + needed_bytes <= RESTORE_CACHE_MAX_BYTES:
+            break
+        await mssql_service.drop_database(name)
+        await asyncio.to_thread(_update_index, name)
+        total -= sizes[name]
+        _stats['evictions'] += 1
+        logger.info(f"Evicted warm database {name} ({sizes[name] / 1024 ** 3:.1f} GB)")
+    if total + needed_bytes > RESTORE_CACHE_MAX_BYTES:
+        logger.warning(f"Restore cache over quota: {(total + needed_bytes) / 1024 ** 3:.1f} GB in use")
+
+async def ready(lease: Lease, size_bytes: int):
+    """Record a finished restore and let waiting jobs for the same backup use it"""
+    if lease.sha256:
+        await asyncio.to_thread(_update_index, lease.database, size_bytes=size_bytes, last_used=time.time())
+    _release_restore_lock(lease)
+
+def _release_restore_lock(lease: Lease):
+    if lease._lock is not None:
+        lease._lock.release()
+        lease._lock = None
+
+async def release(lease: Lease, keep: bool = False):
+    """
+    Give up the hold at job end. A failed restore is dropped so it is not
+    reused half-done, and so is a job's own temporary database unless
+    keep=True (a failed job that may be resumed)
+    """
+    if not lease.sha256:
+        if keep:
+            await mssql_service.close_pool(lease.database)
+            return
+        try:
+            await mssql_service.drop_database(lease.database)
+        except Exception as e:
+            logger.warning(f"Could not drop temporary database {lease.database}: {e}")
+        return
+    if lease._lock is not None:
+        try:
+            await mssql_service.drop_database(lease.database)
+            await asyncio.to_thread(_update_index, lease.database)
+        except Exception as e:
+            logger.warning(f"Could not drop unfinished restore {lease.database}: {e}")
+        _release_restore_lock(lease)
+    await _drop_ref(lease.database)
+
+async def _drop_ref(database: str):
+    _refcounts[database] -= 1
+    if not _refcounts[database]:
+        del _refcounts[database]
+        # Last user gone, close its idle pooled connections
+        await mssql_service.close_pool(database)
+
+def stats() -> Dict[str, Any]:
+    """Hit, miss and eviction counters since startup, and databases in use"""
+    return {**_stats, 'inUse': dict(_refcounts), 'maxBytes': RESTORE_CACHE_MAX_BYTES}
@@ -0,0 +1,141 @@
+"""
+Per-table row plans for COPY.
+A plan is built once from the discovered schema and holds one converter per
+column, so encoding a row does not re-inspect the type of every value.
+"""
+import re
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from services.type_mapper import TEXT_SOURCE_TYPES, map_mssql_to_pg_type, map_mssql_to_binary_copy_type
+
+NULL = '\\N'
+
+# Size of the text and binary pieces handed to the COPY stream
+COPY_CHUNK_CHARS = 1024 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+
+_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_needs_escape = re.compile(r'[\\\t\n\r]').search
+
+def _encode_str(val) -> str:
+    return val.translate(_ESCAPES) if _needs_escape(val) else val
+
+def _encode_bool(val) -> str:
+    return 't' if val else 'f'
+
+def _encode_bytes(val) -> str:
+    return '\\\\x' + val.hex()
+
+def _encode_uuid(val) -> str:
+    # pyodbc returns upper case strings, psycopg returns uuid.UUID
+    return str(val).lower()
+
+def _encode_any(val) -> str:
+    """Fallback for types without a dedicated converter"""
+    if isinstance(val, bytes):
+        return _encode_bytes(val)
+    if isinstance(val, bool):
+        return _encode_bool(val)
+    return _encode_str(str(val))
+
+# Keyed by the PostgreSQL base type from map_mssql_to_pg_type
+_TEXT_ENCODERS: Dict[str, Callable[[Any], str]] = {
+    'INTEGER': str,
+    'BIGINT': str,
+    'SMALLINT': str,
+    'BOOLEAN': _encode_bool,
+    'NUMERIC': str,
+    'DOUBLE PRECISION': str,
+    'REAL': str,
+    'VARCHAR': _encode_str,
+    'CHAR': _encode_str,
+    'TEXT': _encode_str,
+    'XML': _encode_str,
+    'BYTEA': _encode_bytes,
+    'TIMESTAMP': str,
+    'TIMESTAMP WITH TIME ZONE': str,
+    'DATE': str,
+    'TIME': str,
+    'UUID': _encode_uuid,
+}
+
+def _text_encoder(col: Dict[str, Any]) -> Callable[[Any], str]:
+    pg_type = map_mssql_to_pg_type(col['type'], col['max_length'], col['precision'], col['scale'])
+    if pg_type == 'TEXT' and col['type'].lower() not in TEXT_SOURCE_TYPES:
+        # Unknown source type mapped to TEXT, value type is not known in advance
+        return _encode_any
+    return _TEXT_ENCODERS.get(pg_type.split('(')[0], _encode_any)
+
+class RowPlan:
+    """Column converters for one table, shared by the text and binary COPY paths"""
+    def __init__(self, table_meta: Dict[str, Any]):
+        self.columns = [col['name'] for col in table_meta['columns']]
+        self.text_encoders = [_text_encoder(col) for col in table_meta['columns']]
+
+        binary_types = [
+            map_mssql_to_binary_copy_type(col['type'], col['max_length'], col['precision'], col['scale'])
+            for col in table_meta['columns']
+        ]
+        # None if any column can only be sent with text COPY
+        self.binary_types: Optional[List[str]] = None if None in binary_types else binary_types
+        self._uuid_positions = [i for i, t in enumerate(binary_types) if t == 'uuid']
+
+        encoders = self.text_encoders
+
+        def encode_row(row) -> str:
+            return '\t'.join([NULL if val is None else enc(val) for enc, val in zip(encoders, row)])
+
+        self.encode_row = encode_row
+
+    def encode_chunks(self, rows: Iterable[tuple], chunk_chars: int = COPY_CHUNK_CHARS) -> Iterator[str]:
+        """Encode rows in COPY text format, yielding pieces of about chunk_chars"""
+        encode_row = self.encode_row
+        lines = []
+        size = 0
+        for row in rows:
+            line = encode_row(row)
+            lines.append(line)
+            size += len(line) + 1
+            if size >= chunk_chars:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+                size = 0
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    def encode_binary_chunks(self, dump_row: Callable[[tuple, bytearray], None], rows: List[tuple],
+                             chunk_bytes: int = COPY_CHUNK_BYTES) -> Iterator[bytearray]:
+        """
+        Encode rows in binary COPY format with dump_row (postgres_service.binary_row_dumper),
+        yielding pieces of about chunk_bytes
+        """
+        out = bytearray()
+        for row in self.prepare_binary(rows):
+            dump_row(row, out)
+            if len(out) >= chunk_bytes:
+                yield out
+                out = bytearray()
+        if out:
+            yield out
+
+    def prepare_binary(self, rows: List[tuple]) -> List[tuple]:
+        """
+        Convert driver values the binary dumpers cannot take as-is
+        (pyodbc returns uniqueidentifier as str)
+        """
+        if not self._uuid_positions:
+            return rows
+
+        prepared = []
+        for row in rows:
+            row = list(row)
+            for i in self._uuid_positions:
+                if row[i] is not None and not isinstance(row[i], uuid.UUID):
+                    row[i] = uuid.UUID(row[i])
+            prepared.append(tuple(row))
+        return prepared
+
+def build_row_plan(table_meta: Dict[str, Any]) -> RowPlan:
+    """Build the row plan for a discovered table"""
+    return RowPlan(table_meta)
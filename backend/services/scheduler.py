@@ -0,0 +1,125 @@
+"""
+Job scheduler: admits jobs to a limited number of slots per resource class.
+A job holds a restore slot while its backup is verified and restored, a copy
+slot while data is copied or validated, and a constraints slot while keys and
+indexes are built, so a burst of uploads cannot run ten restores against
+MSSQL at once. Waiting jobs are admitted by priority (higher first), then in
+arrival order.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Coroutine, Dict, List, Optional, Set
+
+from models.job import Job
+
+logger = logging.getLogger(__name__)
+
+RESOURCES = ('restore', 'copy', 'constraints')
+
+SLOTS = {
+    'restore': int(os.environ.get('SCHEDULER_RESTORE_SLOTS', '2')),
+    'copy': int(os.environ.get('SCHEDULER_COPY_SLOTS', '2')),
+    'constraints': int(os.environ.get('SCHEDULER_CONSTRAINT_SLOTS', '2')),
+}
+
+_arrival = itertools.count()
+
+class _Waiter:
+    def __init__(self, job: Job):
+        self.job_id = job.job_id
+        self.key = (-job.priority, next(_arrival))
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+class _Resource:
+    """Slots of one resource class with a priority queue of waiting jobs"""
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = max(1, slots)
+        self.in_use = 0
+        self._waiters: List[_Waiter] = []
+
+    def _pending(self) -> List[_Waiter]:
+        return sorted(w for w in self._waiters if not w.future.done())
+
+    async def acquire(self, job: Job):
+        if self.in_use < self.slots and not self._pending():
+            self.in_use += 1
+            return
+        waiter = _Waiter(job)
+        heapq.heappush(self._waiters, waiter)
+        logger.info(f"Job {job.job_id} waiting for a {self.name} slot ({self.in_use}/{self.slots} in use)")
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # Granted just before the cancel: hand the slot on
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # The slot passes straight to the next waiter, in_use stays the same
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                return
+        self.in_use -= 1
+
+    def position(self, job_id: str) -> Optional[int]:
+        for idx, waiter in enumerate(self._pending()):
+            if waiter.job_id == job_id:
+                return idx + 1
+        return None
+
+_resources: Dict[str, _Resource] = {}
+# Running job tasks, referenced so they are not garbage collected mid-run
+_tasks: Set[asyncio.Task] = set()
+
+def _resource(name: str) -> _Resource:
+    if name not in _resources:
+        _resources[name] = _Resource(name, SLOTS[name])
+    return _resources[name]
+
+@asynccontextmanager
+async def slot(resource: str, job: Job):
+    """Hold one slot of a resource class, waiting in the queue if all are taken"""
+    res = _resource(resource)
+    started = time.time()
+    await res.acquire(job)
+    # Time spent queued shows next to the stage timings, e.g. queue_restore
+    durations = job.stats.stage_durations
+    durations[f"queue_{resource}"] = durations.get(f"queue_{resource}", 0) + time.time() - started
+    try:
+        yield
+    finally:
+        res.release()
+
+def submit(coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
+    """Run a job coroutine in the background; it takes its slots as it goes"""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+def queue_position(job_id: str) -> Optional[Dict[str, Any]]:
+    """{'resource', 'position'} (1 = next in line) if the job is waiting for a slot"""
+    for name, res in _resources.items():
+        position = res.position(job_id)
+        if position is not None:
+            return {'resource': name, 'position': position}
+    return None
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Slots, slots in use and waiting jobs per resource class"""
+    return {
+        name: {'slots': res.slots, 'inUse': res.in_use, 'waiting': len(res._pending())}
+        for name, res in ((name, _resource(name)) for name in RESOURCES)
+    }
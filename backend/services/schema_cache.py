@@ -0,0 +1,89 @@
+"""
+Persistent cache of discovery results keyed by the SHA-256 of the .bak file.
+Re-importing the same backup (e.g. into another target schema) reuses the
+discovered schema_info, table sizes and generated DDL instead of querying MSSQL.
+Entries are JSON files; the least recently used ones are evicted once the
+cache grows past SCHEMA_CACHE_MAX_MB.
+"""
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.environ.get('SCHEMA_CACHE_DIR', Path(__file__).parent.parent / "cache" / "schema"))
+CACHE_MAX_BYTES = int(os.environ.get('SCHEMA_CACHE_MAX_MB', '256')) * 1024 * 1024
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def _entry_path(sha256: str) -> Path:
+    return CACHE_DIR / f"{sha256}.json"
+
+def get(sha256: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Cached entry for a backup hash, or None.
+    Entry: {'schema_info': {...}, 'table_sizes': [[schema, table, sizes]], 'ddl': {variant: [sql]}}
+    """
+    if not sha256:
+        return None
+    path = _entry_path(sha256)
+    with _lock:
+        try:
+            entry = json.loads(path.read_text())
+            # Touch for LRU order
+            os.utime(path)
+        except FileNotFoundError:
+            entry = None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable schema cache entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            entry = None
+        _stats['hits' if entry else 'misses'] += 1
+    return entry
+
+def put(sha256: Optional[str], entry: Dict[str, Any]):
+    """Store (or replace) the entry for a backup hash, then evict down to the size limit"""
+    if not sha256:
+        return
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _entry_path(sha256)
+    tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+    with _lock:
+        tmp_path.write_text(json.dumps(entry, default=str))
+        os.replace(tmp_path, path)
+        _evict(keep=path)
+
+def _evict(keep: Path):
+    """Remove least recently used entries until the cache fits CACHE_MAX_BYTES"""
+    entries = []
+    for path in CACHE_DIR.glob("*.json"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda e: e[0]):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total -= size
+        _stats['evictions'] += 1
+        logger.info(f"Evicted schema cache entry {path.name}")
+
+def stats() -> Dict[str, Any]:
+    """Hit, miss and eviction counters since startup, plus current size"""
+    with _lock:
+        entries = list(CACHE_DIR.glob("*.json")) if CACHE_DIR.exists() else []
+        return {
+            **_stats,
+            'entries': len(entries),
+            'bytes': sum(p.stat().st_size for p in entries if p.exists()),
+            'maxBytes': CACHE_MAX_BYTES,
+        }
@@ -1,4 +1,5 @@
 """MSSQL to PostgreSQL type mapping"""
+from typing import Optional
 
 def map_mssql_to_pg_type(mssql_type: str, max_length: int = None, precision: int = None, scale: int = None) -> str:
     """
@@ -71,3 +72,42 @@ def map_mssql_to_pg_type(mssql_type: str, max_length: int = None, precision: int
     # Default fallback
     else:
         return 'TEXT'
+
+# PostgreSQL type (as returned above) -> psycopg type name for binary COPY.
+# bpchar and xml have no binary dumper in psycopg, but their wire format is
+# plain text, so they are sent with the text dumper.
+_BINARY_COPY_TYPES = {
+    'INTEGER': 'int4',
+    'BIGINT': 'int8',
+    'SMALLINT': 'int2',
+    'BOOLEAN': 'bool',
+    'NUMERIC': 'numeric',
+    'DOUBLE PRECISION': 'float8',
+    'REAL': 'float4',
+    'VARCHAR': 'text',
+    'CHAR': 'text',
+    'TEXT': 'text',
+    'BYTEA': 'bytea',
+    'TIMESTAMP': 'timestamp',
+    'DATE': 'date',
+    'TIME': 'time',
+    'TIMESTAMP WITH TIME ZONE': 'timestamptz',
+    'UUID': 'uuid',
+    'XML': 'text',
+}
+
+# MSSQL types that map to TEXT by design; any other type mapped to TEXT is a fallback
+TEXT_SOURCE_TYPES = {'varchar', 'nvarchar', 'text', 'ntext'}
+
+def map_mssql_to_binary_copy_type(mssql_type: str, max_length: int = None, precision: int = None, scale: int = None) -> Optional[str]:
+    """
+    Get the psycopg type name used to send an MSSQL column with binary COPY.
+    Returns None when the column has no exact binary mapping (e.g. types that
+    only fall back to TEXT), in which case text COPY must be used.
+    """
+    pg_type = map_mssql_to_pg_type(mssql_type, max_length, precision, scale)
+    if pg_type == 'TEXT' and mssql_type.lower() not in TEXT_SOURCE_TYPES:
+        return None
+    
+    base_type = pg_type.split('(')[0]
+    return _BINARY_COPY_TYPES.get(base_type)
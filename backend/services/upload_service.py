@@ -1,11 +1,18 @@
 import os
+import errno
+import asyncio
 import hashlib
-import subprocess
+import shutil
+import time
+import uuid
 from pathlib import Path
-from fastapi import UploadFile
-import aiofiles
+from typing import Any, AsyncIterator, Dict, Tuple
 import logging
 
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from utils.tasks import gather_or_cancel
+
 logger = logging.getLogger(__name__)
 
 BACKUP_DIR = Path(__file__).parent.parent / "backups" 
@@ -17,57 +24,323 @@ MAX_FILE_SIZE = 50 * 1024 * 1024 * 1024  # 50 GB
 MSSQL_CONTAINER = os.environ.get('MSSQL_CONTAINER', 'postgrator_mssql')
 MSSQL_BACKUP_PATH = '/var/opt/mssql/backup'
 
-async def save_upload_file(upload_file: UploadFile, job_id: str) -> tuple[str, str]:
+# How the .bak reaches MSSQL:
+#   shared    - written straight into MSSQL_SHARED_BACKUP_DIR, mounted by the MSSQL container (one write)
+#   copy      - written to BACKUP_DIR, then copied into MSSQL_SHARED_BACKUP_DIR in the kernel
+#   docker_cp - written to BACKUP_DIR, then `docker cp` into the container
+UPLOAD_MODE = os.environ.get('UPLOAD_MODE', 'docker_cp')
+# Local path of the directory the MSSQL container sees as MSSQL_BACKUP_PATH
+MSSQL_SHARED_BACKUP_DIR = Path(os.environ.get('MSSQL_SHARED_BACKUP_DIR', BACKUP_DIR))
+
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+# Chunks in flight between the read, hash and write stages
+UPLOAD_QUEUE_DEPTH = int(os.environ.get('UPLOAD_QUEUE_DEPTH', '4'))
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+# Text fields sent with the file (pgUri, schema and the tuning options)
+MAX_FIELD_BYTES = 64 * 1024
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+if UPLOAD_MODE not in ('shared', 'copy', 'docker_cp'):
+    raise ValueError(f"Unknown UPLOAD_MODE: {UPLOAD_MODE}")
+
+def _mb_per_sec(size: int, seconds: float) -> float:
+    return round(size / (1024 ** 2) / max(seconds, 1e-6), 1)
+
+def _stored_dir() -> Path:
+    """Directory the finished .bak lives in"""
+    return BACKUP_DIR if UPLOAD_MODE == 'docker_cp' else MSSQL_SHARED_BACKUP_DIR
+
+class _Chunk:
+    """A reusable buffer and how many stages still need its current contents"""
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.size = 0
+        self.users = 0
+
+    def view(self) -> memoryview:
+        return memoryview(self.buf)[:self.size]
+
+def _write_all(f, data: memoryview):
+    while data:
+        data = data[f.write(data):]
+
+async def _receive_file(source: AsyncIterator[bytes], part_path: Path) -> Tuple[int, str]:
     """
-    Save uploaded .bak file and return (file_path, sha256_hash)
+    Copy a stream of byte pieces into part_path and SHA-256 it on the way. Read,
+    hash and write run as concurrent stages, hash and write in worker threads
+    (hashlib releases the GIL), joined by bounded queues of chunks from a fixed
+    buffer pool. Returns (size, sha256 hex digest)
     """
-    file_path = BACKUP_DIR / f"{job_id}_{upload_file.filename}"
-    
-    # Calculate SHA-256 while saving
+    pool: asyncio.Queue = asyncio.Queue()
+    for _ in range(UPLOAD_QUEUE_DEPTH + 2):
+        pool.put_nowait(_Chunk(UPLOAD_CHUNK_BYTES))
+    hash_queue: asyncio.Queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_DEPTH)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_DEPTH)
     sha256_hash = hashlib.sha256()
     total_size = 0
+    leftover = memoryview(b'')
+    
+    async def fill(buf: bytearray) -> int:
+        # Packs the small pieces the request arrives in into one chunk
+        nonlocal leftover
+        size = 0
+        while size < len(buf):
+            if not leftover:
+                leftover = memoryview(await anext(source, b''))
+                if not leftover:
+                    break
+            count = min(len(leftover), len(buf) - size)
+            buf[size:size + count] = leftover[:count]
+            leftover = leftover[count:]
+            size += count
+        return size
+    
+    def release(chunk: _Chunk):
+        # Back to the pool once both hash and write are done with it
+        chunk.users -= 1
+        if not chunk.users:
+            pool.put_nowait(chunk)
     
-    async with aiofiles.open(file_path, 'wb') as f:
-        while chunk := await upload_file.read(8192 * 1024):  # 8MB chunks
-            total_size += len(chunk)
+    async def read_stage():
+        nonlocal total_size
+        while True:
+            chunk = await pool.get()
+            chunk.size = await fill(chunk.buf)
+            if not chunk.size:
+                break
+            total_size += chunk.size
             if total_size > MAX_FILE_SIZE:
-                # Clean up and raise error
-                await f.close()
-                file_path.unlink(missing_ok=True)
                 raise ValueError(f"Dosya boyutu limiti aşıldı (max {MAX_FILE_SIZE // (1024**3)} GB)")
-            
-            await f.write(chunk)
-            sha256_hash.update(chunk)
+            chunk.users = 2
+            await hash_queue.put(chunk)
+            await write_queue.put(chunk)
+        await hash_queue.put(_DONE)
+        await write_queue.put(_DONE)
     
-    logger.info(f"Dosya kaydedildi: {file_path} ({total_size / (1024**3):.2f} GB)")
+    async def hash_stage():
+        while (chunk := await hash_queue.get()) is not _DONE:
+            await asyncio.to_thread(sha256_hash.update, chunk.view())
+            release(chunk)
     
-    # Docker MSSQL container'ına kopyala
+    async def write_stage():
+        # Unbuffered: chunks go to the kernel as they are, without another copy
+        with open(part_path, 'wb', buffering=0) as f:
+            while (chunk := await write_queue.get()) is not _DONE:
+                await asyncio.to_thread(_write_all, f, chunk.view())
+                release(chunk)
+    
+    # A failing stage stops the others
+    await gather_or_cancel(read_stage(), hash_stage(), write_stage())
+    return total_size, sha256_hash.hexdigest()
+
+async def _multipart_events(body: AsyncIterator[bytes], boundary: bytes) -> AsyncIterator[tuple]:
+    """
+    Parse a multipart body as it arrives. Yields ('part', name, filename) when a
+    part's headers are read, ('data', bytes) for its content and ('end',) after it
+    """
+    events = []
+    headers: Dict[bytes, bytes] = {}
+    header = [b'', b'']
+
+    def on_header_field(data, start, end):
+        header[0] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header[1] += data[start:end]
+
+    def on_header_end():
+        headers[header[0].lower()] = header[1]
+        header[0] = header[1] = b''
+
+    def on_headers_finished():
+        _, params = parse_options_header(headers.get(b'content-disposition', b''))
+        filename = params.get(b'filename')
+        events.append(('part', params.get(b'name', b'').decode(),
+                       None if filename is None else filename.decode()))
+        headers.clear()
+
+    parser = MultipartParser(boundary, {
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': lambda data, start, end: events.append(('data', bytes(data[start:end]))),
+        'on_part_end': lambda: events.append(('end',)),
+    })
+    async for data in body:
+        parser.write(data)
+        for event in events:
+            yield event
+        events.clear()
+    parser.finalize()
+
+async def receive_multipart(body: AsyncIterator[bytes], content_type: str
+                            ) -> Tuple[Dict[str, str], str, Path, str, Dict[str, Any]]:
+    """
+    Read a multipart/form-data body with one .bak file part, writing the file as it
+    arrives straight to where uploads are stored (no spooled temporary copy).
+    Returns (text fields, filename, part_path, sha256, stats with bytes and write_sec);
+    store_upload() then names and delivers part_path. Raises ValueError on a bad body
+    """
+    content_type, params = parse_options_header(content_type)
+    if content_type != b'multipart/form-data' or b'boundary' not in params:
+        raise ValueError("multipart/form-data bekleniyor")
+
+    events = _multipart_events(body, params[b'boundary'])
+    fields: Dict[str, str] = {}
+    filename = None
+    part_path = upload_path(f"upload_{uuid.uuid4().hex}.part")
+    started = time.time()
+
+    async def part_data() -> AsyncIterator[bytes]:
+        async for event in events:
+            if event[0] != 'data':
+                return
+            yield event[1]
+
+    try:
+        async for event in events:
+            if event[0] != 'part':
+                continue
+            _, name, part_filename = event
+            if part_filename is None:
+                value = bytearray()
+                async for data in part_data():
+                    value += data
+                    if len(value) > MAX_FIELD_BYTES:
+                        raise ValueError(f"{name} alanı çok uzun")
+                fields[name] = value.decode()
+                continue
+            if name != 'file' or filename is not None:
+                raise ValueError("Tek bir 'file' alanı bekleniyor")
+            filename = Path(part_filename).name
+            if not filename.endswith('.bak'):
+                raise ValueError("Sadece .bak dosyaları desteklenmektedir")
+            total_size, sha256 = await _receive_file(part_data(), part_path)
+        if filename is None:
+            raise ValueError("file alanı eksik")
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+    write_sec = time.time() - started
+    logger.info(f"Dosya kaydedildi: {part_path} ({total_size / (1024**3):.2f} GB, "
+                f"{_mb_per_sec(total_size, write_sec)} MB/s)")
+    return fields, filename, part_path, sha256, {'bytes': total_size, 'write_sec': write_sec}
+
+async def store_upload(part_path: Path, file_name: str, stats: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Give a received upload its final name and deliver it to MSSQL.
+    Returns (file_path, stats) with transfer_sec (0 in shared mode) and mb_per_sec added
+    """
+    file_path = part_path.with_name(file_name)
+    # MSSQL never sees a half-written file under the final name
+    os.replace(part_path, file_path)
+    file_path, transfer_sec = await deliver(file_path)
+    stats = {
+        **stats,
+        'transfer_sec': transfer_sec,
+        'mb_per_sec': _mb_per_sec(stats['bytes'], stats['write_sec'] + transfer_sec),
+    }
+    return str(file_path), stats
+
+def upload_path(file_name: str) -> Path:
+    """Where an upload is written: MSSQL's directory in shared mode, BACKUP_DIR otherwise"""
+    write_dir = MSSQL_SHARED_BACKUP_DIR if UPLOAD_MODE == 'shared' else BACKUP_DIR
+    write_dir.mkdir(parents=True, exist_ok=True)
+    return write_dir / file_name
+
+async def deliver(file_path: Path) -> Tuple[Path, float]:
+    """Make a finished upload visible to MSSQL per UPLOAD_MODE; returns (final path, seconds spent)"""
+    started = time.time()
+    if UPLOAD_MODE == 'copy':
+        file_path = await _copy_to_shared_dir(file_path)
+    elif UPLOAD_MODE == 'docker_cp':
+        await _docker_cp(file_path)
+    transfer_sec = time.time() - started
+    if UPLOAD_MODE != 'shared':
+        size = file_path.stat().st_size
+        logger.info(f"Transferred to MSSQL in {transfer_sec:.1f}s ({_mb_per_sec(size, transfer_sec)} MB/s)")
+    return file_path, transfer_sec
+
+def _hash_file(path: Path) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+async def hash_file(path: Path) -> str:
+    """SHA-256 of a file, read in a worker thread"""
+    return await asyncio.to_thread(_hash_file, path)
+
+def _copy_file(src: Path, dst: Path) -> int:
+    """
+    Copy src to dst without passing the data through user space:
+    copy_file_range (may reflink or copy server-side), then sendfile, then a plain copy
+    """
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        copied = 0
+        method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile'
+        while copied < size:
+            count = min(COPY_CHUNK_BYTES, size - copied)
+            try:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(fin.fileno(), fout.fileno(), count, copied, copied)
+                elif method == 'sendfile':
+                    fout.seek(copied)
+                    sent = os.sendfile(fout.fileno(), fin.fileno(), copied, count)
+                else:
+                    fin.seek(copied)
+                    fout.seek(copied)
+                    shutil.copyfileobj(fin, fout, COPY_CHUNK_BYTES)
+                    break
+            except OSError as e:
+                # Not supported across these filesystems (or sendfile to a file on this OS)
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK):
+                    raise
+                method = 'sendfile' if method == 'copy_file_range' else 'read_write'
+                continue
+            if sent == 0:
+                break
+            copied += sent
+        logger.debug(f"Copied {src.name} with {method}")
+        return os.fstat(fout.fileno()).st_size
+
+async def _copy_to_shared_dir(file_path: Path) -> Path:
+    """Move the staged upload into MSSQL_SHARED_BACKUP_DIR; returns the new path"""
+    MSSQL_SHARED_BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    target = MSSQL_SHARED_BACKUP_DIR / file_path.name
+    part_path = target.with_name(target.name + ".part")
+    try:
+        # Same filesystem: a rename, no data is copied
+        os.replace(file_path, target)
+        return target
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    try:
+        await asyncio.to_thread(_copy_file, file_path, part_path)
+        os.replace(part_path, target)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    file_path.unlink()
+    return target
+
+async def _docker_cp(file_path: Path):
+    """Copy the file into the MSSQL container with `docker cp`, without blocking the event loop"""
     try:
         # Önce container'ın çalıştığını kontrol et
-        check_result = subprocess.run(
-            ['docker', 'ps', '--filter', f'name={MSSQL_CONTAINER}', '--format', '{{.Names}}'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        stdout = await _docker('ps', '--filter', f'name={MSSQL_CONTAINER}', '--format', '{{.Names}}')
         
-        if MSSQL_CONTAINER not in check_result.stdout:
+        if MSSQL_CONTAINER not in stdout:
             logger.warning(f"Docker container '{MSSQL_CONTAINER}' çalışmıyor!")
             raise Exception(f"MSSQL Docker container çalışmıyor. Lütfen 'docker ps' ile kontrol edin.")
         
-        docker_file_name = f"{job_id}_{upload_file.filename}"
         # Docker'a dosyayı kopyala
-        result = subprocess.run(
-            ['docker', 'cp', str(file_path), f'{MSSQL_CONTAINER}:{MSSQL_BACKUP_PATH}/{docker_file_name}'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        logger.info(f"✅ Dosya Docker container'a kopyalandı: {MSSQL_BACKUP_PATH}/{docker_file_name}")
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Docker'a kopyalama başarısız: {e.stderr}"
-        logger.error(error_msg)
-        raise Exception(error_msg)
+        await _docker('cp', str(file_path), f'{MSSQL_CONTAINER}:{MSSQL_BACKUP_PATH}/{file_path.name}')
+        logger.info(f"✅ Dosya Docker container'a kopyalandı: {MSSQL_BACKUP_PATH}/{file_path.name}")
     except FileNotFoundError:
         error_msg = "Docker komutu bulunamadı. Docker kurulu ve çalışıyor mu?"
         logger.error(error_msg)
@@ -75,12 +348,22 @@ async def save_upload_file(upload_file: UploadFile, job_id: str) -> tuple[str, s
     except Exception as e:
         logger.error(f"Docker kopyalama hatası: {e}")
         raise
-    
-    return str(file_path), sha256_hash.hexdigest()
+
+async def _docker(*args: str) -> str:
+    """Run a docker command and return its stdout, raise with its stderr if it fails"""
+    process = await asyncio.create_subprocess_exec(
+        'docker', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        error_msg = f"Docker'a kopyalama başarısız: {stderr.decode(errors='replace')}"
+        logger.error(error_msg)
+        raise Exception(error_msg)
+    return stdout.decode()
 
 def get_backup_file_path(job_id: str) -> Path:
     """Get backup file path for a job (local filesystem)"""
-    files = list(BACKUP_DIR.glob(f"{job_id}_*"))
+    files = [f for f in _stored_dir().glob(f"{job_id}_*") if not f.name.endswith(".part")]
     if files:
         return files[0]
     return None
@@ -0,0 +1,304 @@
+"""
+Resumable chunked uploads.
+A session preallocates the .bak at its full size; clients PUT numbered chunks,
+in parallel and in any order, and each is written at its offset with its own
+SHA-256. A dropped connection only loses the chunks in flight: the client asks
+which chunks arrived and sends the rest. Completing the session hashes the
+assembled file and hands it over like a regular upload.
+Session state is a JSON file per upload, so it survives a server restart.
+Sessions idle for UPLOAD_SESSION_TTL_SEC are swept with their preallocated files.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from models.job import UploadSession
+from services import upload_service
+from utils.tasks import gather_or_cancel
+
+logger = logging.getLogger(__name__)
+
+SESSION_DIR = Path(os.environ.get('UPLOAD_SESSION_DIR', Path(__file__).parent.parent / "uploads"))
+MIN_CHUNK_BYTES = 1024 * 1024
+MAX_CHUNK_BYTES = 1024 * 1024 * 1024
+UPLOAD_SESSION_TTL_SEC = int(os.environ.get('UPLOAD_SESSION_TTL_SEC', str(24 * 3600)))
+UPLOAD_MAX_SESSIONS = int(os.environ.get('UPLOAD_MAX_SESSIONS', '8'))
+UPLOAD_SESSIONS_MAX_BYTES = int(float(os.environ.get('UPLOAD_SESSIONS_MAX_GB', '200')) * 1024 ** 3)
+
+_sessions: Dict[str, UploadSession] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+# Chunks being written per session; complete() refuses to run while any are
+_writers: Dict[str, Set[int]] = {}
+_create_lock = asyncio.Lock()
+_sweeper: Optional[asyncio.Task] = None
+
+def _session_path(upload_id: str) -> Path:
+    return SESSION_DIR / f"{upload_id}.json"
+
+def data_path(session: UploadSession) -> Path:
+    """The preallocated file chunks are written into, next to where the finished .bak goes"""
+    return upload_service.upload_path(f"upload_{session.upload_id}.part")
+
+def _lock(upload_id: str) -> asyncio.Lock:
+    return _locks.setdefault(upload_id, asyncio.Lock())
+
+def _save(session: UploadSession):
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    path = _session_path(session.upload_id)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(session.model_dump_json())
+    os.replace(tmp_path, path)
+
+def _preallocate(path: Path, size: int):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            # Reserves the blocks, so a full disk fails now instead of at 45 GB
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+async def create(filename: str, size: int, chunk_size: int, job_options: Dict[str, Any],
+                 sha256: Optional[str] = None) -> UploadSession:
+    """Start a session and preallocate its file; raises ValueError on bad sizes"""
+    if not 0 < size <= upload_service.MAX_FILE_SIZE:
+        raise ValueError(f"Dosya boyutu 1 bayt ile {upload_service.MAX_FILE_SIZE // (1024**3)} GB arasında olmalıdır")
+    if not MIN_CHUNK_BYTES <= chunk_size <= MAX_CHUNK_BYTES:
+        raise ValueError(f"chunkSize {MIN_CHUNK_BYTES} ile {MAX_CHUNK_BYTES} bayt arasında olmalıdır")
+    session = UploadSession(filename=filename, size=size, chunk_size=chunk_size, job_options=job_options,
+                            sha256=sha256)
+    async with _create_lock:
+        # Every open session holds its full size on disk until it completes or expires
+        if len(_sessions) >= UPLOAD_MAX_SESSIONS:
+            raise ValueError(f"Aynı anda en fazla {UPLOAD_MAX_SESSIONS} upload açık olabilir")
+        reserved = sum(s.size for s in _sessions.values())
+        if reserved + size > UPLOAD_SESSIONS_MAX_BYTES:
+            raise ValueError(f"Açık upload'lar için ayrılan alan {UPLOAD_SESSIONS_MAX_BYTES / 1024**3:g} GB sınırını aşıyor")
+        await asyncio.to_thread(_preallocate, data_path(session), size)
+        await asyncio.to_thread(_save, session)
+        _sessions[session.upload_id] = session
+    logger.info(f"Upload session {session.upload_id}: {filename}, {size} bytes in {session.chunk_count} chunks")
+    return session
+
+def get(upload_id: str) -> Optional[UploadSession]:
+    """Session by ID, loaded from disk after a restart"""
+    session = _sessions.get(upload_id)
+    if session is None:
+        path = _session_path(upload_id)
+        if not upload_id.isalnum() or not path.exists():
+            return None
+        session = UploadSession.model_validate_json(path.read_text())
+        _sessions[upload_id] = session
+    return session
+
+def _pwrite_all(fd: int, data: bytearray, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+async def write_chunk(session: UploadSession, index: int, body: AsyncIterator[bytes],
+                      expected_sha256: Optional[str] = None) -> str:
+    """
+    Write chunk index from a request body stream at its offset, hashing it on the way.
+    Raises ValueError if the index, length or expected SHA-256 is wrong; the chunk
+    then counts as missing. Returns the chunk's SHA-256
+    """
+    if not 0 <= index < session.chunk_count:
+        raise ValueError(f"Geçersiz chunk numarası: {index}")
+    upload_id = session.upload_id
+    async with _lock(upload_id):
+        # Waits out a running complete(), after which the session is gone
+        if _sessions.get(upload_id) is not session:
+            raise ValueError("Upload tamamlandı veya silindi")
+        writers = _writers.setdefault(upload_id, set())
+        if index in writers:
+            raise ValueError(f"Chunk {index} zaten yazılıyor")
+        writers.add(index)
+        if session.chunk_sha256.pop(index, None) is not None:
+            # A resent chunk overwrites the bytes on disk, so it is missing until it verifies again
+            await asyncio.to_thread(_save, session)
+    try:
+        return await _write_chunk(session, index, body, expected_sha256)
+    finally:
+        writers.discard(index)
+        if not writers:
+            _writers.pop(upload_id, None)
+
+async def _write_chunk(session: UploadSession, index: int, body: AsyncIterator[bytes],
+                       expected_sha256: Optional[str]) -> str:
+    length = session.chunk_length(index)
+    offset = index * session.chunk_size
+    hasher = hashlib.sha256()
+    received = 0
+    pending = bytearray()
+
+    fd = os.open(data_path(session), os.O_WRONLY)
+    try:
+        async def flush():
+            nonlocal received, pending
+            # Write and hash the same buffer at the same time
+            await gather_or_cancel(
+                asyncio.to_thread(_pwrite_all, fd, pending, offset + received),
+                asyncio.to_thread(hasher.update, pending)
+            )
+            received += len(pending)
+            pending = bytearray()
+
+        async for data in body:
+            if received + len(pending) + len(data) > length:
+                raise ValueError(f"Chunk {index} {length} bayttan uzun")
+            pending += data
+            if len(pending) >= upload_service.UPLOAD_CHUNK_BYTES:
+                await flush()
+        if pending:
+            await flush()
+    finally:
+        os.close(fd)
+
+    if received != length:
+        raise ValueError(f"Chunk {index} eksik: {received}/{length} bayt")
+    digest = hasher.hexdigest()
+    if expected_sha256 and expected_sha256.lower() != digest:
+        raise ValueError(f"Chunk {index} SHA-256 uyuşmuyor")
+
+    async with _lock(session.upload_id):
+        session.chunk_sha256[index] = digest
+        session.updated_at = datetime.now(timezone.utc)
+        await asyncio.to_thread(_save, session)
+    return digest
+
+async def _hash_chunks(session: UploadSession) -> Tuple[str, List[str]]:
+    """SHA-256 of the whole file and of every chunk, in one read"""
+    file_hasher = hashlib.sha256()
+    chunk_hashers = []
+    with open(data_path(session), 'rb', buffering=0) as f:
+        for index in range(session.chunk_count):
+            chunk_hasher = hashlib.sha256()
+            remaining = session.chunk_length(index)
+            while remaining:
+                data = await asyncio.to_thread(f.read, min(remaining, upload_service.UPLOAD_CHUNK_BYTES))
+                if not data:
+                    raise ValueError("Upload dosyası beklenenden kısa")
+                # Both hashes release the GIL, so they run side by side
+                await gather_or_cancel(
+                    asyncio.to_thread(file_hasher.update, data),
+                    asyncio.to_thread(chunk_hasher.update, data)
+                )
+                remaining -= len(data)
+            chunk_hashers.append(chunk_hasher.hexdigest())
+    return file_hasher.hexdigest(), chunk_hashers
+
+def missing_chunks(session: UploadSession) -> List[int]:
+    return [i for i in range(session.chunk_count) if i not in session.chunk_sha256]
+
+def writing(session: UploadSession) -> bool:
+    """Whether chunks of the session are still being written"""
+    return bool(_writers.get(session.upload_id))
+
+async def complete(session: UploadSession, job_id: str) -> Tuple[str, str, Dict[str, Any]]:
+    """
+    Turn a fully received session into the job's backup file. The file is hashed again
+    chunk by chunk; chunks that no longer match what was received are dropped and
+    ValueError is raised, as it is when the client's declared SHA-256 differs.
+    Returns (file_path, sha256, stats) like upload_service.save_upload_file, plus hash_sec
+    """
+    async with _lock(session.upload_id):
+        if not data_path(session).exists():
+            raise ValueError("Upload zaten tamamlandı")
+        if writing(session):
+            # A chunk still being written would change the file while it is hashed
+            raise ValueError("Chunk yazımı sürüyor, upload henüz tamamlanamaz")
+        missing = missing_chunks(session)
+        if missing:
+            raise ValueError(f"{len(missing)} chunk eksik")
+        started = time.time()
+        # The whole-file hash keys the schema and restore caches, same as a single upload
+        sha256, chunk_sha256 = await _hash_chunks(session)
+        hash_sec = time.time() - started
+        changed = [i for i, digest in enumerate(chunk_sha256) if session.chunk_sha256.get(i) != digest]
+        if changed:
+            for i in changed:
+                session.chunk_sha256.pop(i, None)
+            await asyncio.to_thread(_save, session)
+            raise ValueError(f"Diskteki veri {len(changed)} chunk ile uyuşmuyor, yeniden gönderilmeli: {changed[:100]}")
+        if session.sha256 and session.sha256.lower() != sha256:
+            raise ValueError("Dosyanın SHA-256'sı bildirilen değerle uyuşmuyor")
+
+        file_path = upload_service.upload_path(f"{job_id}_{session.filename}")
+        os.replace(data_path(session), file_path)
+        discard(session, keep_data=True)
+    file_path, transfer_sec = await upload_service.deliver(file_path)
+
+    # Wall time from session start, including pauses between chunks
+    write_sec = started - session.created_at.timestamp()
+    stats = {
+        'bytes': session.size,
+        'write_sec': write_sec,
+        'hash_sec': hash_sec,
+        'transfer_sec': transfer_sec,
+        'mb_per_sec': round(session.size / (1024 ** 2) / max(write_sec + hash_sec + transfer_sec, 1e-6), 1),
+    }
+    logger.info(f"Upload {session.upload_id} completed as {file_path.name}, hashed in {hash_sec:.1f}s")
+    return str(file_path), sha256, stats
+
+def discard(session: UploadSession, keep_data: bool = False):
+    """Forget a session and remove its files"""
+    _sessions.pop(session.upload_id, None)
+    _locks.pop(session.upload_id, None)
+    _session_path(session.upload_id).unlink(missing_ok=True)
+    if not keep_data:
+        data_path(session).unlink(missing_ok=True)
+
+async def sweep():
+    """Discard sessions idle for longer than UPLOAD_SESSION_TTL_SEC, including ones only on disk"""
+    if not SESSION_DIR.exists():
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL_SEC
+    for path in SESSION_DIR.glob('*.json'):
+        try:
+            session = get(path.stem)
+        except Exception as e:
+            logger.warning(f"Unreadable upload session {path.name}, removing: {e}")
+            path.unlink(missing_ok=True)
+            continue
+        if session is None or session.updated_at.timestamp() > cutoff:
+            continue
+        async with _lock(session.upload_id):
+            if _writers.get(session.upload_id) or _sessions.get(session.upload_id) is not session:
+                continue
+            logger.info(f"Upload session {session.upload_id} expired, removing {session.size} bytes")
+            await asyncio.to_thread(discard, session)
+
+async def start():
+    """Load sessions left on disk, drop expired ones and start the periodic sweep"""
+    global _sweeper
+    await sweep()
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep_loop())
+
+async def stop():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(min(UPLOAD_SESSION_TTL_SEC, 600))
+        try:
+            await sweep()
+        except Exception as e:
+            logger.warning(f"Upload session sweep failed: {e}")
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+class MeteredExecutor:
+    """
+    Bounded thread pool for blocking calls, with queue depth and wait time metrics.
+    Wait time is measured from submission until a worker thread picks the call up.
+    """
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._started = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _invoke(self, submitted_at: float, fn: Callable, args: tuple, kwargs: dict):
+        waited = time.monotonic() - submitted_at
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._started += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) on the pool and await its result"""
+        with self._lock:
+            self._queued += 1
+        future = self._pool.submit(self._invoke, time.monotonic(), fn, args, kwargs)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Cancelling the awaiting task also cancels a call that has not started yet
+            if future.cancelled():
+                with self._lock:
+                    self._queued -= 1
+            raise
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self._started
+            return {
+                "workers": self.max_workers,
+                "running": self._running,
+                "queued": self._queued,
+                "completed": self._completed,
+                "avgWaitMs": round(self._wait_total / started * 1000, 2) if started else 0.0,
+                "maxWaitMs": round(self._wait_max * 1000, 2),
+            }
@@ -0,0 +1,16 @@
+import asyncio
+from typing import Awaitable, List
+
+async def gather_or_cancel(*aws: Awaitable) -> List:
+    """
+    Run awaitables concurrently like asyncio.gather, but if one fails cancel
+    the rest and re-raise the original error
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise